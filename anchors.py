@@ -1,14 +1,17 @@
-import argparse
-
 import os
 import numpy as np
 import random
 import errno
 import glob
-import xml.etree.cElementTree as etree
 import parsers
+import annotation_index
+import utils
 import common
 import itertools
+import json
+import time
+
+CHUNK_SIZE = 65536
 
 def _write_to_file(filename, centroids):
      with open(filename, 'r+') as f:
@@ -39,34 +42,471 @@ def _cluster_bounding_boxes(bounding_boxes, num_anchors=5):
     
     return centroids
 
-def calculate(folder, num_anchors=5, out_file=None):
+def _load_bounding_boxes(folder, workers=None, use_index=False):
+    if use_index:
+        index = annotation_index.load(folder, workers)
+        if index is None or len(index['files']) <= 0:
+            print ("Folder {0} is empty".format(folder))
+            return None
+        bounding_boxes = annotation_index.bounding_boxes(index)
+        print ("Found {0} bounding boxes".format(len(bounding_boxes)))
+        return bounding_boxes
+
     pattern = '{0}/*{1}'.format(folder, '.xml')
     filenames = glob.glob(pattern)    
 
     if len(filenames) <= 0:
         print ("Folder {0} is empty".format(folder))
+        return None
+
+    annotations = parsers.parse_bulk(filenames, workers)
+    bounding_boxes = np.stack([np.abs(annotations['xmax'] - annotations['xmin']), 
+                               np.abs(annotations['ymax'] - annotations['ymin'])], axis=1).astype(np.int32)
+    
+    print ("Found {0} bounding boxes".format(len(bounding_boxes)))
+    return bounding_boxes
+
+def calculate(folder, num_anchors=5, out_file=None, restarts=None, seed=None, workers=1, use_index=False):
+    """
+        Calculate anchors for bounding boxes from folder with *.xml annotations
+        Args:
+            folder: dirname with annotations in Pascal VOC format
+            num_anchors: int (number of anchors)
+            out_file: filename to save anchors (optional)
+            restarts: int (number of k-means++ restarts, see cluster)
+                      None - single run with random seeding
+            seed: int (random seed for restarts)
+            workers: int (number of processes for parsing and restarts)
+            use_index: bool (load bounding boxes from annotation index, see annotation_index)
+
+        Returns:
+            centroids : average tuple (w, h) for each cluster
+    """
+    bounding_boxes = _load_bounding_boxes(folder, workers, use_index)
+    if bounding_boxes is None:
         return
 
-    bounding_boxes = []
-    for fl in filenames:
-        info = parsers.parse_from_pascal_voc_format(fl)
-        if len(info) < 2:
-            continue
-        for bb in info[1]:
-            xn, yn, xx, yx = bb
-            bounding_boxes.append([abs(xx-xn), abs(yx-yn)])
+    if restarts is None:
+        centroids = _cluster_bounding_boxes(bounding_boxes, num_anchors)
+    else:
+        centroids, _ = cluster(bounding_boxes, num_anchors, restarts=restarts, seed=seed, workers=workers)
+
+    if out_file is not None:
+        _save_to_file(centroids, out_file)
+    return centroids
+
+def cluster(bounding_boxes, num_anchors=5, restarts=10, seed=None, workers=1, init='kmeans++', eps=0.05, iterations=100):
+    """
+        Cluster bounding boxes several times and keep the best result
+        Args:
+            bounding_boxes: array of tuples (w, h) for each bounding box
+            num_anchors: int (number of centroids)
+            restarts: int (number of independent k-means runs)
+            seed: int (random seed, same seed gives same result)
+            workers: int (number of processes, None - number of cpus)
+            init: 'kmeans++' (IoU based k-means++ seeding) or 'random'
+            eps: float that indicates stop factor of clustering (converge threshold)
+            iterations: int (max number of iterations)
+
+        Returns:
+            centroids : centroids of the run with the best mean IoU
+            report : list of dicts (seed, iterations, time, mean_iou, centroids) for each restart
+    """
+    bounding_boxes = np.asarray(bounding_boxes)
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, size=max(restarts, 1))
+    tasks = [(bounding_boxes, num_anchors, int(s), init, eps, iterations) for s in seeds]
+
+    report = utils.map_parallel(_run_restart, tasks, workers)
+
+    for i, run in enumerate(report):
+        print ("Restart {0} : iterations = {1}, time = {2:.3f}s, mean IoU = {3:.4f}".format(i, run['iterations'], run['time'], run['mean_iou']))
+
+    best = max(report, key=lambda run: run['mean_iou'])
+    print (best['centroids'])
+    return best['centroids'], report
+
+def calculate_sweep(folder, max_anchors=10, min_anchors=1, out_file=None, restarts=3, seed=None, workers=None, 
+                    use_index=False):
+    """
+        Calculate anchors for every number of anchors in range [min_anchors, max_anchors].
+        Annotations are parsed once for all runs
+        Args:
+            folder: dirname with annotations in Pascal VOC format
+            out_file: filename to save report to (*.json, optional)
+            use_index: bool (load bounding boxes from annotation index, see annotation_index)
+            others: see sweep
+
+        Returns:
+            report : see sweep
+    """
+    bounding_boxes = _load_bounding_boxes(folder, workers, use_index)
+    if bounding_boxes is None:
+        return
+
+    report = sweep(bounding_boxes, max_anchors, min_anchors, restarts, seed, workers)
+    report['folder'] = os.path.abspath(folder)
+    if out_file is not None:
+        _save_report(report, out_file)
+    return report
+
+def sweep(bounding_boxes, max_anchors=10, min_anchors=1, restarts=3, seed=None, workers=None, init='kmeans++', 
+          eps=0.05, iterations=100):
+    """
+        Cluster bounding boxes for each number of anchors k in range [min_anchors, max_anchors]
+        All (k, restart) runs are executed on one process pool
+        Args:
+            bounding_boxes: array of tuples (w, h) for each bounding box
+            max_anchors: int (max number of anchors)
+            min_anchors: int (min number of anchors)
+            restarts: int (number of k-means runs for each k, best one is kept)
+            seed: int (random seed, same seed gives same result)
+            workers: int (number of processes, None - number of cpus)
+            init, eps, iterations: see cluster
+
+        Returns:
+            report : dict with keys
+                boxes : int (number of bounding boxes)
+                results : list of dicts (num_anchors, mean_iou, iterations, time, centroids) for each k
+                recommended : int (k at the elbow of mean IoU curve)
+    """
+    bounding_boxes = np.asarray(bounding_boxes)
+    num_anchors = list(range(min_anchors, max_anchors + 1))
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, size=(len(num_anchors), max(restarts, 1)))
+
+    tasks = []
+    for k, k_seeds in zip(num_anchors, seeds):
+        tasks.extend([(bounding_boxes, k, int(s), init, eps, iterations) for s in k_seeds])
+    runs = utils.map_parallel(_run_restart, tasks, workers)
+
+    results = []
+    for i, k in enumerate(num_anchors):
+        k_runs = runs[i * seeds.shape[1]:(i + 1) * seeds.shape[1]]
+        best = max(k_runs, key=lambda run: run['mean_iou'])
+        results.append({'num_anchors' : k,
+                        'mean_iou' : float(best['mean_iou']),
+                        'iterations' : int(best['iterations']),
+                        'time' : float(sum(run['time'] for run in k_runs)),
+                        'centroids' : best['centroids'].tolist()})
+        print ("Anchors {0} : mean IoU = {1:.4f}".format(k, best['mean_iou']))
+
+    recommended = _elbow([r['num_anchors'] for r in results], [r['mean_iou'] for r in results])
+    print ("Recommended number of anchors = {0}".format(recommended))
+
+    return {'boxes' : int(bounding_boxes.shape[0]),
+            'results' : results,
+            'recommended' : recommended}
+
+def _elbow(x, y):
+    """
+        Find the knee of increasing concave curve y(x): 
+        point with max distance to the line between first and last points (Kneedle)
+    """
+    if len(x) < 3:
+        return x[-1]
+
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    x_range, y_range = x[-1] - x[0], y[-1] - y[0]
+    if y_range <= 0:
+        return int(x[0])
+
+    xn, yn = (x - x[0]) / x_range, (y - y[0]) / y_range
+    return int(x[np.argmax(yn - xn)])
+
+def _save_report(report, filename):
+    filename = os.path.abspath(filename)
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print ("Saved to {0}".format(filename))
+
+def _run_restart(task):
+    bounding_boxes, num_anchors, seed, init, eps, iterations = task
+    start = time.time()
 
-    bounding_boxes = np.array(bounding_boxes, dtype=np.int32)
+    rng = np.random.RandomState(seed)
+    if init == 'kmeans++':
+        centroids = _kmeans_plus_plus(bounding_boxes, num_anchors, rng)
+    else:
+        centroids = bounding_boxes[rng.randint(0, bounding_boxes.shape[0], size=num_anchors)]
+
+    centroids, iteration = _kmeans(bounding_boxes, centroids, eps, iterations, verbose=False)
+    return {'seed' : seed,
+            'iterations' : iteration,
+            'time' : time.time() - start,
+            'mean_iou' : mean_iou(bounding_boxes, centroids),
+            'centroids' : centroids}
+
+def _kmeans_plus_plus(bounding_boxes, num_anchors, rng, chunk_size=CHUNK_SIZE):
+    """
+        k-means++ seeding with (1 - IOU) distance
+        Each next centroid is a bounding box chosen with probability proportional
+        to squared distance to the closest already chosen centroid
+    """
+    count = bounding_boxes.shape[0]
+    indices = [rng.randint(count)]
+    closest = np.ones(count, dtype=np.float64)
+
+    for i in range(1, num_anchors):
+        last = bounding_boxes[indices[-1:]]
+        for start in range(0, count, chunk_size):
+            distances = 1 - _iou(bounding_boxes[start:start + chunk_size], last)[:, 0]
+            np.minimum(closest[start:start + chunk_size], distances, out=closest[start:start + chunk_size])
+
+        weights = closest ** 2
+        total = np.sum(weights)
+        if total <= 0:
+            # All boxes coincide with chosen centroids
+            indices.append(rng.randint(count))
+        else:
+            index = np.searchsorted(np.cumsum(weights), rng.uniform(0, total), side='right')
+            indices.append(min(int(index), count - 1))
+    return bounding_boxes[indices]
+
+def mean_iou(bounding_boxes, centroids, chunk_size=CHUNK_SIZE):
+    """
+        Average IOU between each bounding box and its closest centroid
+    """
+    bounding_boxes = np.asarray(bounding_boxes)
+    if bounding_boxes.shape[0] == 0:
+        return 0.
+
+    total = 0.
+    for start in range(0, bounding_boxes.shape[0], chunk_size):
+        total += np.sum(np.max(_iou(bounding_boxes[start:start + chunk_size], centroids), axis=1))
+    return total / bounding_boxes.shape[0]
     
-    print ("Found {0} bounding boxes", len(bounding_boxes))
+def _iter_batches(folder, batch_size=CHUNK_SIZE, last_file=None):
+    """
+        Read bounding boxes (w, h) from *.xml annotations without loading all of them
+        Files are read in sorted order and batches are built from whole files, 
+        so position in folder can be checkpointed by the last file name
+        Malformed files are reported and skipped
+        Args:
+            folder: dirname with annotations in Pascal VOC format
+            batch_size: int (min number of boxes in batch, except the last one)
+            last_file: basename of last processed file (files up to it are skipped, used to resume)
+
+        Yields:
+            bounding_boxes: array of tuples (w, h) - int32
+            last_file: basename of last file in batch
+    """
+    filenames = sorted(os.path.basename(fl) for fl in parsers.list_files(folder, '.xml'))
+
+    batch = []
+    for name in filenames:
+        if last_file is not None and name <= last_file:
+            continue
+        try:
+            _, _, bboxes = parsers._parse_voc_stream(os.path.join(folder, name))
+        except (Exception) as error:
+            print ("Error parsing {0} : {1}".format(name, error))
+            bboxes = []
+        last_file = name
+        for xn, yn, xx, yx in bboxes:
+            batch.append([abs(xx-xn), abs(yx-yn)])
+
+        if len(batch) >= batch_size:
+            yield np.array(batch, dtype=np.int32), last_file
+            batch = []
 
-    centroids = _cluster_bounding_boxes(bounding_boxes, num_anchors)
+    if len(batch) > 0:
+        yield np.array(batch, dtype=np.int32), last_file
+
+def _save_checkpoint(filename, state):
+    temp = filename + '.tmp.npz'
+    np.savez(temp, **state)
+    os.rename(temp, filename)
+
+def _load_checkpoint(filename):
+    if filename is None or not os.path.exists(filename):
+        return None
+    with np.load(filename) as data:
+        return dict((key, data[key]) for key in data.files)
+
+def calculate_streaming(folder, num_anchors=5, out_file=None, batch_size=CHUNK_SIZE, epochs=3, seed=None, 
+                        checkpoint=None, checkpoint_every=10):
+    """
+        Calculate anchors with mini-batch k-means, reading annotations as a stream.
+        Memory depends on batch_size only, not on number of bounding boxes
+        Args:
+            folder: dirname with annotations in Pascal VOC format
+            num_anchors: int (number of anchors)
+            out_file: filename to save anchors (optional)
+            batch_size: int (number of boxes per mini-batch)
+            epochs: int (number of passes over folder)
+            seed: int (random seed for k-means++ seeding on first batch)
+            checkpoint: filename (*.npz) to save state to and resume from (optional)
+            checkpoint_every: int (save checkpoint every N batches)
+
+        Returns:
+            centroids : average tuple (w, h) for each cluster
+    """
+    folder = os.path.abspath(folder)
+
+    state = _load_checkpoint(checkpoint)
+    if state is not None:
+        if state['centroids'].shape[0] != num_anchors:
+            print ("Checkpoint {0} has {1} anchors, expected {2}".format(checkpoint, state['centroids'].shape[0], num_anchors))
+            return
+        centroids, counts = state['centroids'], state['counts']
+        epoch = int(state['epoch'])
+        last_file = str(state['last_file']) if 'last_file' in state and str(state['last_file']) else None
+        print ("Resumed from {0} : epoch {1}, after file {2}".format(checkpoint, epoch, last_file))
+    else:
+        centroids, counts = None, np.zeros(num_anchors, dtype=np.float64)
+        epoch, last_file = 0, None
+
+    rng = np.random.RandomState(seed)
+    batches = 0
+    while epoch < epochs:
+        total_iou, total_boxes = 0., 0
+        for bounding_boxes, last_file in _iter_batches(folder, batch_size, last_file):
+            if centroids is None:
+                centroids = _kmeans_plus_plus(bounding_boxes, num_anchors, rng).astype(np.float64)
+
+            total_iou += mean_iou(bounding_boxes, centroids) * bounding_boxes.shape[0]
+            total_boxes += bounding_boxes.shape[0]
+
+            centroids, counts = _minibatch_update(bounding_boxes, centroids, counts)
+
+            batches += 1
+            if checkpoint is not None and batches % checkpoint_every == 0:
+                _save_checkpoint(checkpoint, {'centroids' : centroids, 'counts' : counts, 
+                                              'epoch' : epoch, 'last_file' : last_file})
+
+        if centroids is None:
+            print ("Folder {0} is empty".format(folder))
+            return
+
+        print ("Epoch {0} : boxes = {1}, mean IoU = {2:.4f}".format(epoch, total_boxes, 
+                                                                 total_iou / max(total_boxes, 1)))
+        epoch, last_file = epoch + 1, None
+        if checkpoint is not None:
+            # Empty name - start of epoch
+            _save_checkpoint(checkpoint, {'centroids' : centroids, 'counts' : counts, 
+                                          'epoch' : epoch, 'last_file' : ''})
+
+    centroids = centroids.astype(np.int32)
+    print (centroids)
     if out_file is not None:
         _save_to_file(centroids, out_file)
     return centroids
-    
-def _cluster(bounding_boxes, centroids, eps=0.05, iterations=100):
+
+def _minibatch_update(bounding_boxes, centroids, counts):
+    """
+        Mini-batch k-means step: move each centroid towards the mean of boxes 
+        assigned to it with per centroid learning rate 1 / (number of boxes seen)
+    """
+    centroids_count = centroids.shape[0]
+    closest_centroids = np.argmin(1 - _iou(bounding_boxes, centroids), axis=1)
+
+    batch_counts = np.bincount(closest_centroids, minlength=centroids_count)
+    batch_sums = np.zeros(centroids.shape, np.float64)
+    for d in range(centroids.shape[1]):
+        batch_sums[:, d] = np.bincount(closest_centroids, weights=bounding_boxes[:, d], minlength=centroids_count)
+
+    counts = counts + batch_counts
+    assigned = batch_counts != 0
+    centroids = centroids.copy()
+    centroids[assigned] += (batch_sums[assigned] - batch_counts[assigned][:, np.newaxis] * centroids[assigned]) / counts[assigned][:, np.newaxis]
+    return centroids, counts
+
+def _cluster(bounding_boxes, centroids, eps=0.05, iterations=100, chunk_size=CHUNK_SIZE, verbose=True):
+    centroids, _ = _kmeans(bounding_boxes, centroids, eps, iterations, chunk_size, verbose)
+    return centroids
+
+def _kmeans(bounding_boxes, centroids, eps=0.05, iterations=100, chunk_size=CHUNK_SIZE, verbose=True):
+    """
+        Cluster existing bounding boxes to N classes.
+        Based on K-Means clustering algorithm.
+        Vectorized: distances are computed for chunks of boxes at once, so memory
+        stays bounded by chunk_size x len(centroids) no matter how many boxes are used.
+        Args: 
+            bounding_boxes: array of tuples (w, h) for each bounding box
+            centroids: array of random defined centroids based on existing bounding boxes
+                       represented as tuples (w, h)
+            eps: float that indicates stop factor of clustering (converge threshold)
+            iterations: int (max number of iterations)
+            chunk_size: int (number of boxes processed at once)
+            verbose: bool (print progress for each iteration)
+        
+        Returns: 
+            centroids : average tuple (w, h) for each cluster
+            iteration : int (number of iterations took)
+    """
+
+    bounding_boxes = np.asarray(bounding_boxes)
+    centroids = np.array(centroids)
+    previous_centroids = None
+    iteration, difference = 0, 1e5
+    centroids_count = centroids.shape[0]
+
+    while True:
+        iteration+=1
+
+        # Per chunk: distances (1 - IOU) to current centroids, closest centroid assignment
+        # and distances to previous centroids (converge check) without storing N x K matrices
+        centroid_sums = np.zeros(centroids.shape, np.float64)
+        counts = np.zeros(centroids_count, np.int64)
+        total_difference = 0.
+        for start in range(0, bounding_boxes.shape[0], chunk_size):
+            chunk = bounding_boxes[start:start + chunk_size]
+            distances = 1 - _iou(chunk, centroids)
+
+            if previous_centroids is not None:
+                previous_distances = 1 - _iou(chunk, previous_centroids)
+                total_difference += np.sum(np.abs(distances - previous_distances))
+
+            closest_centroids = np.argmin(distances, axis=1)
+            counts += np.bincount(closest_centroids, minlength=centroids_count)
+            for d in range(centroids.shape[1]):
+                centroid_sums[:, d] += np.bincount(closest_centroids, weights=chunk[:, d], minlength=centroids_count)
+
+        if previous_centroids is not None:
+            difference = total_difference
+
+        if verbose:
+            print ("Iteration {0} : difference = {1}".format(iteration, difference))
+
+        # Exit loop if centroids converged or reached max number of iterations 
+        if difference < eps or iteration > iterations:
+            if verbose:
+                print ("Iterations took = %d"%(iteration))
+            return centroids, iteration
+
+        # Calculate new centroids (Each centroid is the geometric mean of the points that closest to it)
+        previous_centroids = centroids.copy()
+        assigned = counts != 0
+        centroids[assigned] = centroid_sums[assigned] / counts[assigned][:, np.newaxis]
+    return centroids, iteration
+
+
+def _iou(x, centroids):
+    """
+        Calculates intersection over union between (w,h) and every centroids (cw, ch)
+        Args: 
+            x: tuple (width, height) of bounding box or array of tuples (N x 2)
+            centroids: list of tuples (width, height) that represents average (w, h) of each cluster
+
+        Returns: 
+            Array of iou's (K) for a single box, or matrix of iou's (N x K) for array of boxes
+    """
+
+    boxes = np.asarray(x, dtype=np.float64)
+    centroids = np.asarray(centroids, dtype=np.float64)
+    single = boxes.ndim == 1
+    boxes = np.atleast_2d(boxes)
+
+    w, h = boxes[:, 0:1], boxes[:, 1:2] # N x 1
+    cw, ch = centroids[:, 0], centroids[:, 1] # K
+
+    intersection = np.minimum(w, cw) * np.minimum(h, ch)
+    union = w * h + cw * ch - intersection
+    ious = intersection / union
+    return ious[0] if single else ious
+
+def _cluster_loop(bounding_boxes, centroids, eps=0.05, iterations=100, verbose=True):
     """
+        Reference (per box) implementation of _cluster. Kept for benchmarking.
         Cluster existing bounding boxes to N classes.
         Based on K-Means clustering algorithm
         Args: 
@@ -91,18 +531,20 @@ def _cluster(bounding_boxes, centroids, eps=0.05, iterations=100):
         # Based on YOLO v2 data preparation procedure
         distances = []          
         for i in range(bounding_boxes.shape[0]):
-            distances.append((1 - _iou(bounding_boxes[i],centroids)))
+            distances.append((1 - _iou_loop(bounding_boxes[i],centroids)))
         distances = np.array(distances)
         
         # Calculate difference between new/old (converge check)
         if len(previous_distances) > 0:
             difference = np.sum(np.abs(distances-previous_distances))
         
-        print ("Iteration {0} : difference = {1}".format(iteration, difference))
+        if verbose:
+            print ("Iteration {0} : difference = {1}".format(iteration, difference))
         
         # Exit loop if centroids converged or reached max number of iterations 
         if difference < eps or iteration > iterations:
-            print ("Iterations took = %d"%(iteration))
+            if verbose:
+                print ("Iterations took = %d"%(iteration))
             return centroids
 
         # Assign data points to closest centroids
@@ -110,7 +552,7 @@ def _cluster(bounding_boxes, centroids, eps=0.05, iterations=100):
         closest_centroids = np.argmin(distances,axis=1)
 
         # Calculate new centroids (Each centroid is the geometric mean of the points that closest to it)
-        centroid_sums=np.zeros((centroids_count,centroid_size),np.float)
+        centroid_sums=np.zeros((centroids_count,centroid_size),np.float64)
         for i in range(closest_centroids.shape[0]):
             centroid_sums[closest_centroids[i]]+=bounding_boxes[i]
         
@@ -123,8 +565,9 @@ def _cluster(bounding_boxes, centroids, eps=0.05, iterations=100):
     return centroids
 
 
-def _iou(x,centroids):
+def _iou_loop(x,centroids):
     """
+        Reference (per centroid) implementation of _iou. Kept for benchmarking.
         Calculates intersection over union between (w,h) and every centroids (cw, ch)
         Args: 
             x: tuple (width, height) of bounding box
@@ -0,0 +1,237 @@
+import os
+
+import numpy as np
+
+import parsers
+
+INDEX_FILENAME = '.annotations_index.npz'
+BOX_KEYS = ['file_index', 'class_id', 'xmin', 'ymin', 'xmax', 'ymax']
+# Malformed files are remembered too, so they are not parsed again until they change
+ERROR_KEYS = ['error_files', 'error_messages', 'error_mtime', 'error_size']
+
+
+def index_filename(folder):
+    return os.path.join(os.path.abspath(folder), INDEX_FILENAME)
+
+def _scan(folder, file_format='.xml'):
+    """
+        List files of specific format with their modification time and size
+        Returns:
+            dict basename -> (mtime, size)
+    """
+    stats = {}
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith(file_format):
+            continue
+        st = os.stat(os.path.join(folder, name))
+        stats[name] = (st.st_mtime, st.st_size)
+    return stats
+
+def _stat(filename):
+    st = os.stat(filename)
+    return (st.st_mtime, st.st_size)
+
+def _empty():
+    index = {'files' : [], 'images' : [], 'mtime' : np.zeros(0, dtype=np.float64),
+             'size' : np.zeros(0, dtype=np.int64), 'classes' : []}
+    for key in BOX_KEYS:
+        index[key] = np.zeros(0, dtype=np.int32)
+    index.update(_errors([]))
+    return index
+
+def _errors(entries):
+    """
+        Error columns from list of tuples (basename, message, mtime, size)
+    """
+    return {'error_files' : [entry[0] for entry in entries],
+            'error_messages' : [entry[1] for entry in entries],
+            'error_mtime' : np.array([entry[2] for entry in entries], dtype=np.float64),
+            'error_size' : np.array([entry[3] for entry in entries], dtype=np.int64)}
+
+def _error_entries(index):
+    return list(zip(index['error_files'], index['error_messages'], index['error_mtime'], index['error_size']))
+
+def read(folder):
+    """
+        Read annotation index of folder as is (without checking files)
+        Returns:
+            index: dict (see load) or None if index not exists
+    """
+    filename = index_filename(folder)
+    if not os.path.exists(filename):
+        return None
+
+    with np.load(filename) as data:
+        index = dict((key, data[key]) for key in data.files)
+    if 'error_files' not in index:
+        # Index written before errors were recorded
+        index.update(_errors([]))
+    for key in ('files', 'images', 'classes', 'error_files', 'error_messages'):
+        index[key] = [str(value) for value in index[key]]
+    return index
+
+def write(folder, index):
+    """
+        Save annotation index atomically (write to temp file and rename)
+    """
+    filename = index_filename(folder)
+    temp = filename + '.tmp.npz'
+
+    arrays = dict((key, index[key]) for key in BOX_KEYS + ['mtime', 'size'])
+    arrays['files']   = np.array(index['files'], dtype=np.str_)
+    arrays['images']  = np.array(index['images'], dtype=np.str_)
+    arrays['classes'] = np.array(index['classes'], dtype=np.str_)
+    arrays['error_files']    = np.array(index['error_files'], dtype=np.str_)
+    arrays['error_messages'] = np.array(index['error_messages'], dtype=np.str_)
+    arrays['error_mtime']    = index['error_mtime']
+    arrays['error_size']     = index['error_size']
+    np.savez(temp, **arrays)
+    os.rename(temp, filename)
+    return filename
+
+def _select(index, keep, classes):
+    """
+        Take files (by mask) with their boxes from index, remap class ids to merged classes
+        (only classes of taken boxes, in order of first box as parse_bulk does)
+    """
+    box_mask = keep[index['file_index']]
+    new_file_index = np.cumsum(keep) - 1
+    class_ids = index['class_id'][box_mask]
+    used, first = np.unique(class_ids, return_index=True)
+    mapping = np.full(len(index['classes']), -1, dtype=np.int32)
+    for i in used[np.argsort(first)]:
+        mapping[i] = classes.setdefault(index['classes'][i], len(classes))
+
+    part = {'files' : [fl for fl, k in zip(index['files'], keep) if k],
+            'images' : [im for im, k in zip(index['images'], keep) if k],
+            'mtime' : index['mtime'][keep],
+            'size' : index['size'][keep]}
+    part['file_index'] = new_file_index[index['file_index'][box_mask]].astype(np.int32)
+    part['class_id'] = mapping[class_ids]
+    for key in ('xmin', 'ymin', 'xmax', 'ymax'):
+        part[key] = index[key][box_mask]
+    return part
+
+def _merge(parts, classes):
+    index = _empty()
+    offset = 0
+    for part in parts:
+        index['files'].extend(part['files'])
+        index['images'].extend(part['images'])
+        for key in BOX_KEYS + ['mtime', 'size']:
+            value = part[key] + offset if key == 'file_index' else part[key]
+            index[key] = np.concatenate([index[key], value]).astype(index[key].dtype)
+        offset += len(part['files'])
+    index['classes'] = sorted(classes, key=classes.get)
+    return index
+
+def load(folder, workers=None, save=True):
+    """
+        Load annotation index of folder, parse only new or changed *.xml files
+        Args:
+            folder: dirname with annotations in Pascal VOC format
+            workers: int (number of processes to parse changed files, None - number of cpus)
+            save: bool (write updated index back to folder)
+
+        Returns:
+            index: dict with keys
+                files: list of annotation basenames
+                images: list of image filenames for each annotation
+                mtime, size: arrays with modification time and size of each annotation
+                classes: list of class names
+                file_index, class_id, xmin, ymin, xmax, ymax: int32 arrays, one element per bounding box
+                errors: list of tuples (filename, error message) for malformed files
+                        (they are parsed again only when changed)
+    """
+    folder = os.path.abspath(folder)
+    if not os.path.exists(folder):
+        print ("Folder {0} not exists".format(folder))
+        return None
+
+    stats = _scan(folder)
+    index = read(folder)
+    if index is None:
+        index = _empty()
+
+    # Keep files with the same mtime and size
+    keep = np.array([fl in stats and stats[fl] == (mtime, size)
+                     for fl, mtime, size in zip(index['files'], index['mtime'], index['size'])], dtype=bool)
+    kept = set(fl for fl, k in zip(index['files'], keep) if k)
+    kept_errors = [entry for entry in _error_entries(index) if stats.get(entry[0]) == (entry[2], entry[3])]
+    known = kept | set(entry[0] for entry in kept_errors)
+    changed = [fl for fl in sorted(stats) if fl not in known]
+
+    classes = {}
+    parts = [_select(index, keep, classes)]
+
+    errors = kept_errors
+    dirty = len(changed) > 0 or len(kept) != len(index['files']) or len(kept_errors) != len(index['error_files'])
+    if dirty:
+        parsed = parsers.parse_bulk([os.path.join(folder, fl) for fl in changed], workers)
+        errors = errors + [(os.path.basename(fl), message) + stats[os.path.basename(fl)]
+                           for fl, message in parsed['errors']]
+        valid = np.array([image is not None for image in parsed['images']], dtype=bool)
+
+        parsed['files'] = [os.path.basename(fl) for fl in parsed['files']]
+        parsed['mtime'] = np.array([stats[fl][0] for fl in parsed['files']], dtype=np.float64)
+        parsed['size'] = np.array([stats[fl][1] for fl in parsed['files']], dtype=np.int64)
+        parts.append(_select(parsed, valid, classes))
+
+        removed = len([fl for fl in index['files'] + index['error_files'] if fl not in stats])
+        print ("Parsed {0} new or changed files, {1} unchanged, {2} removed".format(len(changed), len(known), removed))
+
+    index = _merge(parts, classes)
+    index.update(_errors(errors))
+    index['errors'] = [(os.path.join(folder, entry[0]), entry[1]) for entry in errors]
+    if save and dirty:
+        write(folder, index)
+    return index
+
+def update(folder, parsed, save=True):
+    """
+        Put freshly parsed annotations of folder to index without parsing them again
+        (e.g. after rewrite, see relabel), other files of index are kept as is
+        Args:
+            folder: dirname with annotations
+            parsed: dict (see parsers.parse_bulk) with files of folder
+
+        Returns:
+            index: see load
+    """
+    folder = os.path.abspath(folder)
+    index = read(folder)
+    if index is None:
+        index = _empty()
+
+    names = [os.path.basename(fl) for fl in parsed['files']]
+    stats = [os.stat(os.path.join(folder, name)) for name in names]
+    updated = set(names)
+    keep = np.array([fl not in updated for fl in index['files']], dtype=bool)
+
+    classes = {}
+    parts = [_select(index, keep, classes)]
+
+    parsed = dict(parsed)
+    parsed['files'] = names
+    parsed['mtime'] = np.array([st.st_mtime for st in stats], dtype=np.float64)
+    parsed['size'] = np.array([st.st_size for st in stats], dtype=np.int64)
+    valid = np.array([image is not None for image in parsed['images']], dtype=bool)
+    parts.append(_select(parsed, valid, classes))
+
+    errors = [entry for entry in _error_entries(index) if entry[0] not in updated]
+    errors += [(os.path.basename(fl), message) + _stat(os.path.join(folder, os.path.basename(fl)))
+               for fl, message in parsed['errors']]
+
+    index = _merge(parts, classes)
+    index.update(_errors(errors))
+    index['errors'] = [(os.path.join(folder, entry[0]), entry[1]) for entry in errors]
+    if save:
+        write(folder, index)
+    return index
+
+def bounding_boxes(index):
+    """
+        Bounding boxes sizes (w, h) from index - int32
+    """
+    return np.stack([np.abs(index['xmax'] - index['xmin']),
+                     np.abs(index['ymax'] - index['ymin'])], axis=1).astype(np.int32)
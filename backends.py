@@ -0,0 +1,143 @@
+import os
+import json
+
+import numpy as np
+
+BACKENDS = ('darkflow', 'tensorflow', 'opencv', 'onnx')
+
+
+def load_meta(filename):
+    """
+        Read darkflow meta file (json with inp_size, labels, anchors, thresh, colors, ...)
+    """
+    with open(filename, 'r') as fp:
+        return json.load(fp)
+
+def _check_region(meta, backend):
+    # Only darkflow knows how to decode YOLO v1 detection layer, others use yolo_net.decode_region
+    if meta.get('type') != '[region]':
+        raise ValueError("Backend {0} supports only YOLO v2 region models, got {1}".format(backend, meta.get('type')))
+
+def _model_file(options, key, extension):
+    if key in options:
+        return options[key]
+    if 'pbLoad' in options:
+        return os.path.splitext(options['pbLoad'])[0] + extension
+    raise ValueError("Option {0} is required".format(key))
+
+
+class DarkflowBackend(object):
+    """
+        darkflow TFNet (builds net from cfg/weights or pbLoad/metaLoad)
+    """
+
+    def __init__(self, options, tfnet=None):
+        if tfnet is None:
+            from darkflow.net.build import TFNet
+            tfnet = TFNet(options)
+        self.tfnet = tfnet
+        self.meta = load_meta(options['metaLoad']) if 'metaLoad' in options else tfnet.meta
+
+    def forward(self, batch):
+        return self.tfnet.sess.run(self.tfnet.out, {self.tfnet.inp : batch})
+
+    def findboxes(self, net_out):
+        return self.tfnet.framework.findboxes(net_out)
+
+
+class TensorflowBackend(object):
+    """
+        Frozen graph (.pb saved by darkflow --savepb) in plain TF session, without darkflow
+    """
+
+    def __init__(self, options):
+        import tensorflow as tf
+        if hasattr(tf, 'compat') and hasattr(tf.compat, 'v1'):
+            tf = tf.compat.v1
+        self.meta = load_meta(options['metaLoad'])
+        _check_region(self.meta, 'tensorflow')
+
+        graph_def = tf.GraphDef()
+        with open(options['pbLoad'], 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+
+        threads = options.get('threads', 0)
+        config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads)
+        self.sess = tf.Session(graph=graph, config=config)
+        self.inp = graph.get_tensor_by_name(options.get('input_name', 'input') + ':0')
+        self.out = graph.get_tensor_by_name(options.get('output_name', 'output') + ':0')
+
+    def forward(self, batch):
+        return self.sess.run(self.out, {self.inp : batch})
+
+
+class OpencvBackend(object):
+    """
+        OpenCV DNN module (reads the same frozen graph, no TensorFlow needed)
+    """
+
+    def __init__(self, options):
+        import cv2
+        self.meta = load_meta(options['metaLoad'])
+        _check_region(self.meta, 'opencv')
+
+        self.net = cv2.dnn.readNetFromTensorflow(options['pbLoad'])
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        if options.get('threads'):
+            cv2.setNumThreads(options['threads'])
+        self.output_name = options.get('output_name', 'output')
+
+    def forward(self, batch):
+        # OpenCV DNN works in NCHW layout
+        self.net.setInput(np.ascontiguousarray(batch.transpose(0, 3, 1, 2)))
+        out = self.net.forward(self.output_name)
+        return out.transpose(0, 2, 3, 1)
+
+
+class OnnxBackend(object):
+    """
+        ONNX Runtime, model is converted from the frozen graph once, e.g.
+        python -m tf2onnx.convert --input model.pb --inputs input:0 --outputs output:0 --output model.onnx
+    """
+
+    def __init__(self, options):
+        import onnxruntime
+        self.meta = load_meta(options['metaLoad'])
+        _check_region(self.meta, 'onnx')
+
+        session_options = onnxruntime.SessionOptions()
+        if options.get('threads'):
+            session_options.intra_op_num_threads = options['threads']
+        self.sess = onnxruntime.InferenceSession(_model_file(options, 'onnxLoad', '.onnx'), session_options,
+                                                 providers=['CPUExecutionProvider'])
+        self.input_name = self.sess.get_inputs()[0].name
+
+    def forward(self, batch):
+        return self.sess.run(None, {self.input_name : batch})[0]
+
+
+def create(options, tfnet=None):
+    """
+        Create inference backend selected by options['backend'] (default - darkflow)
+        Args:
+            options: dict (backend, pbLoad, metaLoad, onnxLoad, threads, ...)
+            tfnet: already built darkflow TFNet (or stand-in with the same interface, e.g. benchmark.StubTFNet)
+
+        Returns:
+            backend with meta (dict) and forward(batch) -> raw net output (N x H x W x C)
+    """
+    backend = options.get('backend', 'darkflow')
+    if tfnet is not None or backend == 'darkflow':
+        return DarkflowBackend(options, tfnet)
+    if backend == 'tensorflow':
+        return TensorflowBackend(options)
+    if backend == 'opencv':
+        return OpencvBackend(options)
+    if backend == 'onnx':
+        return OnnxBackend(options)
+    raise ValueError("Unknown backend {0}, expected one of {1}".format(backend, BACKENDS))
@@ -0,0 +1,482 @@
+import argparse
+import os
+import time
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import anchors
+import parsers
+import utils
+import yolo_net
+
+
+def _timeit(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+def _random_boxes(count, seed=12345, max_size=500):
+    """
+        Generate synthetic bounding boxes sizes
+        Args:
+            count: int (number of boxes)
+            seed: int (random seed)
+            max_size: int (max width/height of box)
+
+        Returns:
+            bounding_boxes: array of tuples (w, h) - int32
+    """
+    rng = np.random.RandomState(seed)
+    return rng.randint(1, max_size, size=(count, 2)).astype(np.int32)
+
+def bench_anchors(sizes=(10000, 100000, 1000000), num_anchors=5, iterations=10, max_loop_size=1000000):
+    """
+        Compare vectorized anchors._cluster with per box anchors._cluster_loop
+        Both run exactly `iterations` iterations (eps < 0) from the same centroids
+        Args:
+            sizes: list of ints (number of boxes)
+            num_anchors: int (number of centroids)
+            iterations: int (number of k-means iterations)
+            max_loop_size: int (skip per box implementation for bigger sets)
+    """
+    print ("{0:>10} {1:>12} {2:>12} {3:>10} {4:>6}".format('boxes', 'loop, s', 'vector, s', 'speedup', 'equal'))
+    for size in sizes:
+        bounding_boxes = _random_boxes(size)
+        random.seed(12345)
+        indices = [ random.randrange(bounding_boxes.shape[0]) for i in range(num_anchors)]
+        initial = bounding_boxes[indices]
+
+        vector, vector_time = _timeit(anchors._cluster, bounding_boxes, initial.copy(), eps=-1, iterations=iterations, verbose=False)
+
+        loop_time, equal = None, None
+        if size <= max_loop_size:
+            loop, loop_time = _timeit(anchors._cluster_loop, bounding_boxes, initial.copy(), eps=-1, iterations=iterations, verbose=False)
+            equal = np.array_equal(loop, vector)
+
+        print ("{0:>10} {1:>12} {2:>12.3f} {3:>10} {4:>6}".format(size,
+                   '-' if loop_time is None else '{0:.3f}'.format(loop_time),
+                   vector_time,
+                   '-' if loop_time is None else '{0:.1f}x'.format(loop_time / vector_time),
+                   '-' if equal is None else str(equal)))
+
+class _StubBox(object):
+    def __init__(self, x, y, w, h, probs):
+        self.x, self.y, self.w, self.h = x, y, w, h
+        self.probs = probs
+
+class _StubFramework(object):
+    def __init__(self, meta):
+        self.meta = meta
+
+    def findboxes(self, net_out):
+        # Like darkflow: one python object per predicted box
+        xywh, probs = yolo_net.decode_region(net_out, self.meta)
+        return [_StubBox(x, y, w, h, p) for (x, y, w, h), p in zip(xywh, probs)]
+
+class _StubSession(object):
+    def __init__(self, grid, channels, call_overhead):
+        self.grid = grid
+        self.call_overhead = call_overhead
+        self.weights = np.random.RandomState(0).randn(3, channels).astype(np.float32)
+
+    def run(self, out, feed_dict):
+        # Fixed cost per call (graph dispatch) + cost per image (pooling and projection)
+        time.sleep(self.call_overhead)
+        inp = list(feed_dict.values())[0]
+        b, h, w, c = inp.shape
+        g = self.grid
+        pooled = inp[:, :h // g * g, :w // g * g].reshape(b, g, h // g, g, w // g, c).mean(axis=(2, 4))
+        return np.dot(pooled, self.weights) * 4.
+
+class StubTFNet(object):
+    """
+        Stand-in for darkflow TFNet (inp, out, sess, framework, meta) with YOLO v2 region output 
+        that runs without model files
+    """
+    def __init__(self, inp_size=(416, 416, 3), grid=13, labels=('apple', 'banana'), threshold=0.3, call_overhead=0.01):
+        anchors = [1.08, 1.19, 3.42, 4.41, 6.63, 11.38, 9.42, 5.11, 16.62, 10.52]
+        self.inp, self.out = 'input', 'output'
+        self.meta = {'inp_size' : list(inp_size),
+                     'out_size' : [grid, grid, len(anchors) // 2 * (5 + len(labels))],
+                     'type' : '[region]',
+                     'num' : len(anchors) // 2,
+                     'anchors' : anchors,
+                     'classes' : len(labels),
+                     'labels' : list(labels),
+                     'thresh' : threshold,
+                     'colors' : [(0, 255, 0)] * len(labels)}
+        self.sess = _StubSession(grid, self.meta['out_size'][2], call_overhead)
+        self.framework = _StubFramework(self.meta)
+
+def create_stub_net(**kwargs):
+    return yolo_net.YoloNet({}, tfnet=StubTFNet(**kwargs))
+
+def _random_images(count, shape=(480, 640, 3), seed=12345):
+    rng = np.random.RandomState(seed)
+    image = rng.randint(0, 255, size=shape).astype(np.uint8)
+    for i in range(count):
+        yield image
+
+def bench_detect_batch(batch_sizes=(1, 2, 4, 8, 16), count=64, call_overhead=0.01):
+    """
+        Throughput (images/s) of YoloNet.detect_batch for each batch size, using stub network
+    """
+    net = create_stub_net(call_overhead=call_overhead)
+
+    _, single_time = _timeit(lambda: [net.detect(image) for image in _random_images(count)])
+    print ("{0:>10} {1:>12} {2:>10}".format('batch', 'images/s', 'speedup'))
+    print ("{0:>10} {1:>12.1f} {2:>10}".format('detect', count / single_time, '1.0x'))
+    for batch_size in batch_sizes:
+        _, batch_time = _timeit(lambda: list(net.detect_batch(_random_images(count), batch_size)))
+        print ("{0:>10} {1:>12.1f} {2:>10}".format(batch_size, count / batch_time, '{0:.1f}x'.format(single_time / batch_time)))
+
+def _resize_input_legacy(im, inp_size):
+    # Previous YoloNet._resize_input + expand_dims and float32 cast done by session feed
+    h, w, c = inp_size
+    imsz = cv2.resize(im, (w, h))
+    imsz = imsz / 255.
+    imsz = imsz[:,:,::-1]
+    return np.asarray(np.expand_dims(imsz, 0), dtype=np.float32)
+
+def _measure(func, count):
+    """
+        Mean time per call and peak of memory allocated by calls (numpy and cv2 arrays are traced)
+        Returns:
+            (ms per call, peak MB)
+    """
+    func()
+    tracemalloc.start()
+    start = time.time()
+    for _ in range(count):
+        func()
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed / count * 1000., peak / 1e6
+
+def bench_preprocess(count=200, shape=(480, 640, 3)):
+    """
+        Per frame time and allocations of net input preprocessing: previous implementation,
+        YoloNet._resize_input with reusable buffers (stretch and letterbox)
+    """
+    image = next(_random_images(1, shape))
+    net = create_stub_net()
+    letterbox_net = yolo_net.YoloNet({'letterbox' : True}, tfnet=StubTFNet())
+    inp_size = net.meta['inp_size']
+
+    legacy = _resize_input_legacy(image, inp_size)
+    net._resize_input(image)
+    print ("Same input as previous implementation : {0}".format(np.array_equal(legacy[0], net._input[0])))
+
+    print ("{0:>12} {1:>12} {2:>12}".format('method', 'ms/frame', 'peak MB'))
+    for name, func in (('previous', lambda: _resize_input_legacy(image, inp_size)),
+                       ('buffered', lambda: net._resize_input(image)),
+                       ('letterbox', lambda: letterbox_net._resize_input(image))):
+        ms, peak = _measure(func, count)
+        print ("{0:>12} {1:>12.3f} {2:>12.3f}".format(name, ms, peak))
+
+def bench_server(clients=(1, 4, 16), count=64, workers=2, batch_size=8, max_latency=0.01, call_overhead=0.01):
+    """
+        Throughput and latency of detection_server with stub network for number of concurrent clients
+    """
+    import threading
+    import detection_server
+
+    service = detection_server.DetectionService(create_stub_net, (), workers, batch_size, max_latency,
+                                                max_queue=max(clients) * 2).start()
+    server = detection_server.DetectionServer(service, port=0)
+    thread = threading.Thread(target=server.serve)
+    thread.daemon = True
+    thread.start()
+    port = server.server_address[1]
+
+    data = cv2.imencode('.jpg', next(_random_images(1)))[1].tobytes()
+    net = create_stub_net(call_overhead=call_overhead)
+    image = next(_random_images(1))
+    _, single_time = _timeit(lambda: [net.detect(image) for _ in range(count)])
+
+    print ("{0:>10} {1:>12} {2:>12} {3:>12}".format('clients', 'images/s', 'p50, ms', 'mean batch'))
+    print ("{0:>10} {1:>12.1f} {2:>12} {3:>12}".format('detect', count / single_time, '-', '-'))
+    try:
+        for n in clients:
+            service.stats = detection_server.ServerStats()
+
+            def run():
+                client = detection_server.DetectionClient(port=port)
+                for _ in range(count // n):
+                    client.detect(data)
+                client.close()
+
+            threads = [threading.Thread(target=run) for _ in range(n)]
+            start = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.time() - start
+
+            report = service.stats.report()
+            print ("{0:>10} {1:>12.1f} {2:>12.1f} {3:>12.1f}".format(n, report['ok'] / elapsed,
+                       report['latency_p50_ms'], report['mean_batch_size']))
+    finally:
+        server.shutdown()
+        thread.join()
+
+def bench_backends(model_name=None, folder='.', names=('stub', 'darkflow', 'tensorflow', 'opencv', 'onnx'),
+                   count=32, batch_size=8, threads=0):
+    """
+        Startup time, first and mean per image latency and batch throughput of each backend on CPU
+        ('stub' - StubTFNet, runs without model files). Unavailable backends are skipped
+    """
+    images = list(_random_images(count))
+    print ("{0:>12} {1:>12} {2:>12} {3:>12} {4:>12}".format('backend', 'startup, s', 'first, ms', 'latency, ms', 'images/s'))
+    for name in names:
+        try:
+            if name == 'stub':
+                net, startup = _timeit(create_stub_net, call_overhead=0.)
+            else:
+                if model_name is None:
+                    raise ValueError("model name is required")
+                options = {'backend' : name, 'threads' : threads}
+                net, startup = _timeit(yolo_net.create_net, model_name, folder, options)
+        except (Exception) as error:
+            print ("{0:>12} skipped : {1}".format(name, error))
+            continue
+
+        _, first = _timeit(net.detect, images[0])
+        _, single = _timeit(lambda: [net.detect(image) for image in images])
+        _, batch = _timeit(lambda: list(net.detect_batch(images, batch_size)))
+        print ("{0:>12} {1:>12.3f} {2:>12.1f} {3:>12.1f} {4:>12.1f}".format(name, startup, first * 1000.,
+                   single / count * 1000., count / batch))
+
+def _import_time(module):
+    code = "import time; start = time.time(); import {0}; print(time.time() - start)".format(module)
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(output.decode('utf-8').strip().splitlines()[-1])
+
+def bench_startup(model_name=None, folder='.', options={}):
+    """
+        Time to first detection: module import (fresh interpreter), net load (cold and from registry),
+        first inference without and with warm up. Without model_name stub net is used
+    """
+    print ("{0:<40} {1:>10}".format('step', 'ms'))
+    for module in ('numpy', 'cv2', 'yolo_net'):
+        print ("{0:<40} {1:>10.1f}".format('import ' + module, _import_time(module) * 1000.))
+
+    image = next(_random_images(1))
+    if model_name is None:
+        create = lambda: create_stub_net()
+    else:
+        create = lambda: yolo_net.create_net(model_name, folder, options, reuse=False)
+    net, load = _timeit(create)
+    _, first = _timeit(net.detect, image)
+    _, second = _timeit(net.detect, image)
+    print ("{0:<40} {1:>10.1f}".format('load net', load * 1000.))
+    print ("{0:<40} {1:>10.1f}".format('first detect (cold)', first * 1000.))
+    print ("{0:<40} {1:>10.1f}".format('second detect', second * 1000.))
+
+    net = create()
+    _, warmup = _timeit(net.warmup)
+    _, first = _timeit(net.detect, image)
+    print ("{0:<40} {1:>10.1f}".format('warm up', warmup * 1000.))
+    print ("{0:<40} {1:>10.1f}".format('first detect after warm up', first * 1000.))
+
+    if model_name is not None:
+        yolo_net.create_net(model_name, folder, options)
+        _, cached = _timeit(yolo_net.create_net, model_name, folder, options)
+        print ("{0:<40} {1:>10.1f}".format('create_net from registry', cached * 1000.))
+
+def _make_split(folder, count, shape=(480, 640, 3), seed=12345):
+    """
+        Synthetic split_tt.split_all output: <folder>/train/images/*.jpg and train/annotations/*.xml
+    """
+    rng = np.random.RandomState(seed)
+    images_folder, annotations_folder = os.path.join(folder, 'train', 'images'), os.path.join(folder, 'train', 'annotations')
+    utils.make_dir(images_folder)
+    utils.make_dir(annotations_folder)
+    h, w = shape[:2]
+    for i in range(count):
+        name = '{0:06d}'.format(i)
+        image = cv2.GaussianBlur(rng.randint(0, 255, size=shape).astype(np.uint8), (0, 0), 3)
+        cv2.imwrite(os.path.join(images_folder, name + '.jpg'), image)
+        objects = ''
+        for _ in range(rng.randint(1, 4)):
+            x1, y1 = rng.randint(0, w // 2), rng.randint(0, h // 2)
+            x2, y2 = x1 + rng.randint(10, w // 2), y1 + rng.randint(10, h // 2)
+            objects += ('<object><name>{0}</name><bndbox><xmin>{1}</xmin><ymin>{2}</ymin><xmax>{3}</xmax>'
+                        '<ymax>{4}</ymax></bndbox></object>').format(rng.choice(['apple', 'banana']), x1, y1, x2, y2)
+        with open(os.path.join(annotations_folder, name + '.xml'), 'w') as f:
+            f.write('<annotation><filename>{0}.jpg</filename><size><width>{1}</width><height>{2}</height>'
+                    '<depth>3</depth></size>{3}</annotation>'.format(name, w, h, objects))
+
+def _read_loose(files, order, resize=None):
+    for i in order:
+        annotation, image = files[i]
+        parsers.parse_from_pascal_voc_format(annotation)
+        image = cv2.imread(image)
+        if resize is not None:
+            cv2.resize(image, resize)
+
+def _read_records(reader, order, resize=None):
+    for i in order:
+        image = reader[i]['image']
+        if resize is not None and image.shape[1::-1] != resize:
+            cv2.resize(image, resize)
+
+def bench_records(count=1000, samples_per_shard=250, resize=(416, 416), workers=None):
+    """
+        Random access read speed (samples/s): loose jpg + xml files vs packed records
+        (original jpg, jpg resized to net input, raw resized pixels). Every reader yields net sized images
+    """
+    import records
+    root = tempfile.mkdtemp()
+    try:
+        _make_split(root, count)
+        annotations = sorted(parsers.list_files(os.path.join(root, 'train', 'annotations'), '.xml'))
+        files = [(fl, os.path.join(root, 'train', 'images', utils.get_filename(fl) + '.jpg')) for fl in annotations]
+        order = np.random.RandomState(0).permutation(count)
+
+        print ("{0:>14} {1:>12} {2:>12} {3:>10}".format('format', 'pack, s', 'samples/s', 'MB'))
+        _, loose_time = _timeit(_read_loose, files, order, resize)
+        size = sum(os.path.getsize(fl) for pair in files for fl in pair) / 1e6
+        print ("{0:>14} {1:>12} {2:>12.1f} {3:>10.1f}".format('loose', '-', count / loose_time, size))
+
+        for name, pack_resize, encoding in (('records', None, 'jpg'), ('records-416', resize, 'jpg'),
+                                            ('records-raw', resize, 'raw')):
+            out = os.path.join(root, name)
+            _, pack_time = _timeit(records.pack, root, out, 'train', samples_per_shard=samples_per_shard,
+                                   resize=pack_resize, encoding=encoding, workers=workers)
+            reader = records.RecordReader(out, 'train')
+            _, read_time = _timeit(_read_records, reader, order, resize)
+            size = sum(os.path.getsize(os.path.join(out, fl)) for fl in os.listdir(out)) / 1e6
+            print ("{0:>14} {1:>12.2f} {2:>12.1f} {3:>10.1f}".format(name, pack_time, count / read_time, size))
+    finally:
+        shutil.rmtree(root)
+
+def _make_files(folder, names, extension):
+    utils.make_dir(folder)
+    for name in names:
+        open(os.path.join(folder, name + extension), 'w').close()
+
+def _pair_nested(annotations_folder, images_folder):
+    # Nested loop over names (as in Fruits notebook)
+    anns = [utils.get_filename(fl) for fl in parsers.list_files(annotations_folder, '.xml')]
+    imgs = [utils.get_filename(fl) for fl in parsers.list_files(images_folder, '.jpg')]
+    cnt = 0
+    for i in anns:
+        for j in imgs:
+            if i == j:
+                cnt += 1
+                break
+    return cnt
+
+def _pair_exists(annotations_folder, images_folder):
+    # os.path.exists for each annotation (previous split_tt._remove_without_image)
+    cnt = 0
+    for fl in parsers.list_files(annotations_folder, '.xml'):
+        if os.path.exists(os.path.join(images_folder, utils.get_filename(fl) + '.jpg')):
+            cnt += 1
+    return cnt
+
+def bench_pairing(sizes=(1000, 10000, 100000), max_nested=10000):
+    """
+        Matching annotations with images: nested loop, exists per file and parsers.pair_files
+        Each synthetic folder has N annotations and 0.9 N images (10% orphans on both sides)
+    """
+    print ("{0:>10} {1:>12} {2:>12} {3:>12}".format('files', 'nested, s', 'exists, s', 'pair, s'))
+    for size in sizes:
+        root = tempfile.mkdtemp()
+        try:
+            annotations_folder, images_folder = os.path.join(root, 'annotations'), os.path.join(root, 'images')
+            _make_files(annotations_folder, ['{0:08d}'.format(i) for i in range(size)], '.xml')
+            _make_files(images_folder, ['{0:08d}'.format(i) for i in range(size // 10, size + size // 10)], '.jpg')
+
+            nested_time = None
+            if size <= max_nested:
+                _, nested_time = _timeit(_pair_nested, annotations_folder, images_folder)
+            _, exists_time = _timeit(_pair_exists, annotations_folder, images_folder)
+            result, pair_time = _timeit(parsers.pair_files, annotations_folder, images_folder)
+
+            print ("{0:>10} {1:>12} {2:>12.3f} {3:>12.3f}".format(size, 
+                       '-' if nested_time is None else '{0:.3f}'.format(nested_time), exists_time, pair_time))
+        finally:
+            shutil.rmtree(root)
+
+def main():
+    parser = argparse.ArgumentParser(description='Performance benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+
+    anchors_parser = subparsers.add_parser('anchors', help='anchors k-means: loop vs vectorized')
+    anchors_parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    anchors_parser.add_argument('--num-anchors', type=int, default=5)
+    anchors_parser.add_argument('--iterations', type=int, default=10)
+    anchors_parser.add_argument('--max-loop-size', type=int, default=1000000)
+
+    batch_parser = subparsers.add_parser('detect-batch', help='YoloNet.detect_batch throughput with stub network')
+    batch_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    batch_parser.add_argument('--count', type=int, default=64)
+    batch_parser.add_argument('--call-overhead', type=float, default=0.01)
+
+    pairing_parser = subparsers.add_parser('pairing', help='annotation/image matching on synthetic folders')
+    pairing_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    pairing_parser.add_argument('--max-nested', type=int, default=10000)
+
+    preprocess_parser = subparsers.add_parser('preprocess', help='YoloNet input preprocessing time and allocations')
+    preprocess_parser.add_argument('--count', type=int, default=200)
+    preprocess_parser.add_argument('--shape', type=int, nargs=3, default=[480, 640, 3])
+
+    server_parser = subparsers.add_parser('server', help='detection_server throughput with stub network')
+    server_parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16])
+    server_parser.add_argument('--count', type=int, default=64)
+    server_parser.add_argument('--workers', type=int, default=2)
+    server_parser.add_argument('--batch-size', type=int, default=8)
+    server_parser.add_argument('--max-latency', type=float, default=0.01)
+
+    backends_parser = subparsers.add_parser('backends', help='YoloNet inference backends on CPU')
+    backends_parser.add_argument('--model', default=None, help='model name (<folder>/<model>.pb and .meta)')
+    backends_parser.add_argument('--folder', default='.')
+    backends_parser.add_argument('--backends', nargs='+', default=['stub', 'darkflow', 'tensorflow', 'opencv', 'onnx'])
+    backends_parser.add_argument('--count', type=int, default=32)
+    backends_parser.add_argument('--batch-size', type=int, default=8)
+    backends_parser.add_argument('--threads', type=int, default=0)
+
+    startup_parser = subparsers.add_parser('startup', help='import, load and first inference time')
+    startup_parser.add_argument('--model', default=None, help='model name (<folder>/<model>.pb and .meta), default - stub')
+    startup_parser.add_argument('--folder', default='.')
+    startup_parser.add_argument('--backend', default='darkflow')
+
+    records_parser = subparsers.add_parser('records', help='packed records vs loose files read speed')
+    records_parser.add_argument('--count', type=int, default=1000)
+    records_parser.add_argument('--samples-per-shard', type=int, default=250)
+    records_parser.add_argument('--resize', type=int, nargs=2, default=[416, 416])
+    records_parser.add_argument('--workers', type=int, default=None)
+
+    args = parser.parse_args()
+    if args.command == 'anchors':
+        bench_anchors(args.sizes, args.num_anchors, args.iterations, args.max_loop_size)
+    elif args.command == 'detect-batch':
+        bench_detect_batch(args.batch_sizes, args.count, args.call_overhead)
+    elif args.command == 'pairing':
+        bench_pairing(args.sizes, args.max_nested)
+    elif args.command == 'preprocess':
+        bench_preprocess(args.count, tuple(args.shape))
+    elif args.command == 'server':
+        bench_server(args.clients, args.count, args.workers, args.batch_size, args.max_latency)
+    elif args.command == 'backends':
+        bench_backends(args.model, args.folder, args.backends, args.count, args.batch_size, args.threads)
+    elif args.command == 'startup':
+        bench_startup(args.model, args.folder, {'backend' : args.backend})
+    elif args.command == 'records':
+        bench_records(args.count, args.samples_per_shard, tuple(args.resize), args.workers)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
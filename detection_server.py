@@ -0,0 +1,527 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import collections
+import multiprocessing
+
+import numpy as np
+
+if sys.version_info >= (3,):
+    import queue
+    import http.client as httplib
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+else:
+    import Queue as queue
+    import httplib
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+
+def _worker(net_factory, factory_args, tasks, results):
+    """
+        Worker process: builds its own net once and runs batches of encoded images
+        Results are lists of boxes (YoloNet.detect format) or (status, error message) for each image
+    """
+    import cv2
+    net = net_factory(*factory_args)
+    results.put(('ready', os.getpid(), None))
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        batch_id, encoded = task
+
+        images, outputs = [], [None] * len(encoded)
+        for i, data in enumerate(encoded):
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                outputs[i] = (400, "can't decode image")
+            else:
+                images.append((i, image))
+        try:
+            for (i, _), boxes in zip(images, net.detect_batch([image for _, image in images], max(len(images), 1))):
+                outputs[i] = boxes
+        except (Exception) as error:
+            for i, _ in images:
+                outputs[i] = (500, str(error))
+        results.put(('batch', batch_id, outputs))
+
+
+class DetectionError(RuntimeError):
+
+    def __init__(self, message, status=500):
+        super(DetectionError, self).__init__(message)
+        self.status = status
+
+
+class _Request(object):
+
+    def __init__(self, data, timeout):
+        self.data = data
+        self.created = time.time()
+        self.deadline = self.created + timeout
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.status = None
+
+
+class ServerStats(object):
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.counts = {'requests' : 0, 'ok' : 0, 'rejected' : 0, 'timeouts' : 0, 'errors' : 0, 'batches' : 0}
+        self.batched = 0
+        self.latencies = collections.deque(maxlen=window)
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.counts[key] += value
+
+    def batch(self, size):
+        with self.lock:
+            self.counts['batches'] += 1
+            self.batched += size
+
+    def latency(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def report(self):
+        with self.lock:
+            report = dict(self.counts)
+            latencies = np.array(self.latencies) * 1000.
+            report['uptime_s'] = time.time() - self.start
+            report['mean_batch_size'] = self.batched / float(max(self.counts['batches'], 1))
+            for name, q in (('p50', 50), ('p95', 95), ('p99', 99)):
+                report['latency_{0}_ms'.format(name)] = float(np.percentile(latencies, q)) if len(latencies) else 0.
+            return report
+
+
+class DetectionService(object):
+    """
+        Pool of worker processes, each holds one net. Requests are gathered into micro-batches:
+        a batch is sent when it has batch_size images or its first request waited max_latency seconds.
+        Bounded request queue gives backpressure (submit fails at once when it's full),
+        requests not finished in time are answered with timeout
+    """
+
+    def __init__(self, net_factory, factory_args=(), workers=1, batch_size=8, max_latency=0.01,
+                 max_queue=64, timeout=5., start_timeout=60.):
+        """
+            Args:
+                net_factory: picklable (module level) callable(*factory_args) -> YoloNet,
+                             e.g. yolo_net.create_net or benchmark.create_stub_net
+                factory_args: tuple of arguments of net_factory
+                workers: int (number of processes)
+                batch_size: int (max images per batch)
+                max_latency: float (seconds, max time the first request of batch waits for others)
+                max_queue: int (max number of waiting requests)
+                timeout: float (seconds, default request timeout)
+                start_timeout: float (seconds to wait until workers load nets)
+        """
+        self.net_factory = net_factory
+        self.factory_args = tuple(factory_args)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.timeout = timeout
+        self.start_timeout = start_timeout
+
+        self.requests = queue.Queue(maxsize=max_queue)
+        self.stats = ServerStats()
+        # batch id -> (worker index, requests)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        # At most two batches per worker are in flight, the rest waits (and times out) in request queue
+        self.in_flight = threading.BoundedSemaphore(2 * workers)
+        self.processes, self.threads, self.tasks = [], [], []
+        self.results = None
+        self._dead = set()
+        self._stop = threading.Event()
+        self._batch_id = 0
+        self._ready = 0
+
+    def start(self):
+        # Each worker has its own task queue, so batches of a dead worker are known
+        self.tasks = [multiprocessing.Queue() for _ in range(self.workers)]
+        self.results = multiprocessing.Queue()
+        for tasks in self.tasks:
+            process = multiprocessing.Process(target=_worker,
+                                              args=(self.net_factory, self.factory_args, tasks, self.results))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+        start = time.time()
+        while self._ready < self.workers:
+            try:
+                kind, _, _ = self.results.get(timeout=max(self.start_timeout - (time.time() - start), 0.01))
+            except queue.Empty:
+                self.stop()
+                raise RuntimeError("Workers are not ready in {0} seconds".format(self.start_timeout))
+            if kind == 'ready':
+                self._ready += 1
+
+        self.threads = [threading.Thread(target=self._batcher), threading.Thread(target=self._collector)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        print ("Detection service started : {0} workers".format(self.workers))
+        return self
+
+    def stop(self):
+        self._stop.set()
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join(1.)
+            if process.is_alive():
+                process.terminate()
+        if self.results is not None:
+            self.results.put(('stop', None, None))
+        for thread in self.threads:
+            thread.join()
+        self.processes, self.threads, self.tasks = [], [], []
+
+    def submit(self, data, timeout=None):
+        """
+            Detect objects on encoded (jpg, png, ...) image
+            Returns:
+                boxes in YoloNet.detect format
+            Raises:
+                queue.Full - service is overloaded,
+                DetectionError - timeout (status 504), bad image (400) or failed detection (500)
+        """
+        request = _Request(data, timeout if timeout is not None else self.timeout)
+        self.stats.count('requests')
+        try:
+            self.requests.put_nowait(request)
+        except queue.Full:
+            self.stats.count('rejected')
+            raise
+
+        if not request.done.wait(max(request.deadline - time.time(), 0)) and request.error is None:
+            request.error, request.status = 'timeout', 504
+        if request.error is not None:
+            self.stats.count('timeouts' if request.status == 504 else 'errors')
+            raise DetectionError(request.error, request.status)
+
+        self.stats.count('ok')
+        self.stats.latency(time.time() - request.created)
+        return request.result
+
+    def health(self):
+        alive = len([p for p in self.processes if p.is_alive()])
+        return {'status' : 'ok' if alive == self.workers and not self._stop.is_set() else 'degraded',
+                'workers' : self.workers,
+                'alive' : alive,
+                'queue' : self.requests.qsize()}
+
+    def metrics(self):
+        report = self.stats.report()
+        report.update(self.health())
+        return report
+
+    def _next_batch(self):
+        """
+            Wait for first request, then gather more until batch is full or max_latency passed
+        """
+        try:
+            first = self.requests.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = first.created + self.max_latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                batch.append(self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _batcher(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+
+            # Requests that already timed out are not worth computing
+            now = time.time()
+            batch = [request for request in batch if request.deadline > now]
+            if len(batch) == 0:
+                continue
+
+            while not self.in_flight.acquire(False):
+                if self._stop.is_set():
+                    return
+                time.sleep(0.001)
+
+            with self.pending_lock:
+                alive = [i for i in range(self.workers) if i not in self._dead]
+                if len(alive) == 0:
+                    self.in_flight.release()
+                    self._fail(batch, 'no workers alive')
+                    continue
+                # Least loaded alive worker
+                load = dict((i, 0) for i in alive)
+                for worker, _ in self.pending.values():
+                    if worker in load:
+                        load[worker] += 1
+                worker = min(alive, key=lambda i: load[i])
+                self._batch_id += 1
+                self.pending[self._batch_id] = (worker, batch)
+            self.stats.batch(len(batch))
+            self.tasks[worker].put((self._batch_id, [request.data for request in batch]))
+
+    def _collector(self):
+        while True:
+            try:
+                kind, batch_id, outputs = self.results.get(timeout=0.5)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if kind == 'stop':
+                break
+            if kind != 'batch':
+                continue
+            with self.pending_lock:
+                item = self.pending.pop(batch_id, None)
+            if item is None:
+                continue
+            self.in_flight.release()
+            for request, output in zip(item[1], outputs):
+                if isinstance(output, list):
+                    request.result = output
+                else:
+                    request.status, request.error = output
+                request.done.set()
+            self._check_workers()
+
+    def _check_workers(self):
+        """
+            Fail batches of dead workers at once (instead of letting them time out) and free their slots
+        """
+        if self._stop.is_set():
+            return
+        failed = []
+        with self.pending_lock:
+            for i, process in enumerate(self.processes):
+                if i in self._dead or process.is_alive():
+                    continue
+                self._dead.add(i)
+                print ("Worker {0} (pid {1}) died with exit code {2}".format(i, process.pid, process.exitcode))
+                for batch_id, (worker, batch) in list(self.pending.items()):
+                    if worker == i:
+                        del self.pending[batch_id]
+                        failed.append(batch)
+        for batch in failed:
+            self.in_flight.release()
+            self._fail(batch, 'worker died')
+
+    def _fail(self, batch, message, status=500):
+        for request in batch:
+            request.status, request.error = status, message
+            request.done.set()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+        POST /detect (body - encoded image, optional header X-Timeout in seconds) -> json list of boxes
+        GET /health, GET /metrics -> json
+    """
+    protocol_version = 'HTTP/1.1'
+    # Keep-alive with small responses: without it every response waits for delayed ACK
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        if self.server.unix_socket is not None:
+            # TCP_NODELAY doesn't exist for Unix sockets
+            self.disable_nagle_algorithm = False
+        BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+        if self.path == '/health':
+            health = self.server.service.health()
+            self._reply(200 if health['status'] == 'ok' else 503, health)
+        elif self.path == '/metrics':
+            self._reply(200, self.server.service.metrics())
+        else:
+            self._reply(404, {'error' : 'not found'})
+
+    def do_POST(self):
+        if self.path != '/detect':
+            self._reply(404, {'error' : 'not found'})
+            return
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        timeout = self.headers.get('X-Timeout')
+        try:
+            boxes = self.server.service.submit(data, float(timeout) if timeout else None)
+        except queue.Full:
+            self._reply(503, {'error' : 'overloaded'})
+            return
+        except DetectionError as error:
+            self._reply(error.status, {'error' : str(error)})
+            return
+        self._reply(200, boxes)
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class DetectionServer(ThreadingMixIn, HTTPServer):
+    """
+        HTTP front end of DetectionService on TCP port or Unix socket (unix_socket - path)
+    """
+    daemon_threads = True
+    # Listen backlog (socketserver default is 5): burst of connections has to reach the service,
+    # which answers overload with 503, instead of being refused by the kernel
+    request_queue_size = 128
+
+    def __init__(self, service, host='127.0.0.1', port=8000, unix_socket=None, verbose=False):
+        self.service = service
+        self.verbose = verbose
+        self.unix_socket = unix_socket
+        self.request_queue_size = max(self.request_queue_size, service.requests.maxsize)
+        if unix_socket is not None:
+            self.address_family = socket.AF_UNIX
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            HTTPServer.__init__(self, unix_socket, _Handler)
+        else:
+            HTTPServer.__init__(self, (host, port), _Handler)
+
+    def server_bind(self):
+        if self.unix_socket is not None:
+            # HTTPServer.server_bind expects (host, port) address
+            self.socket.bind(self.server_address)
+            self.server_name, self.server_port = 'localhost', 0
+        else:
+            HTTPServer.server_bind(self)
+
+    def serve(self):
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+            self.service.stop()
+            if self.unix_socket is not None and os.path.exists(self.unix_socket):
+                os.remove(self.unix_socket)
+
+
+class _TcpConnection(httplib.HTTPConnection):
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _UnixConnection(httplib.HTTPConnection):
+    # Unix sockets have no Nagle's algorithm, so there is no TCP_NODELAY to set
+
+    def __init__(self, path, timeout=10):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class DetectionClient(object):
+    """
+        Client of DetectionServer, keeps one keep-alive connection (use one client per thread)
+    """
+
+    def __init__(self, host='127.0.0.1', port=8000, unix_socket=None, timeout=10):
+        if unix_socket is not None:
+            self.connection = _UnixConnection(unix_socket, timeout)
+        else:
+            self.connection = _TcpConnection(host, port, timeout=timeout)
+
+    def detect(self, image, ext='.png', timeout=None):
+        """
+            Args:
+                image: BGR image or already encoded image (bytes)
+                ext: encoding of image array ('.png' - lossless, '.jpg' - smaller)
+            Returns:
+                (status, boxes or error dict)
+        """
+        if isinstance(image, np.ndarray):
+            import cv2
+            image = cv2.imencode(ext, image)[1].tobytes()
+        headers = {'Content-Type' : 'application/octet-stream'}
+        if timeout is not None:
+            headers['X-Timeout'] = str(timeout)
+        return self._request('POST', '/detect', image, headers)
+
+    def health(self):
+        return self._request('GET', '/health')
+
+    def metrics(self):
+        return self._request('GET', '/metrics')
+
+    def close(self):
+        self.connection.close()
+
+    def _request(self, method, path, body=None, headers={}):
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        return response.status, json.loads(response.read().decode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local detection server')
+    parser.add_argument('--model', help='model name (<folder>/<model>.pb and .meta)')
+    parser.add_argument('--folder', default='.')
+    parser.add_argument('--threshold', type=float, default=0.3)
+    parser.add_argument('--stub', action='store_true', help='stub network (benchmark.StubTFNet), no model files')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix-socket', default=None)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--max-latency', type=float, default=0.01)
+    parser.add_argument('--max-queue', type=int, default=64)
+    parser.add_argument('--timeout', type=float, default=5.)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if args.stub:
+        import benchmark
+        factory, factory_args = benchmark.create_stub_net, ()
+    elif args.model:
+        import yolo_net
+        factory, factory_args = yolo_net.create_net, (args.model, args.folder, {'threshold' : args.threshold})
+    else:
+        parser.error('--model or --stub is required')
+
+    service = DetectionService(factory, factory_args, args.workers, args.batch_size, args.max_latency,
+                               args.max_queue, args.timeout).start()
+    server = DetectionServer(service, args.host, args.port, args.unix_socket, args.verbose)
+    print ("Serving on {0}".format(args.unix_socket or '{0}:{1}'.format(args.host, args.port)))
+    server.serve()
+
+if __name__ == '__main__':
+    main()
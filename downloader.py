@@ -0,0 +1,336 @@
+import os
+import sys
+import time
+import hashlib
+import threading
+
+import utils
+
+if sys.version_info >= (3,):
+    import http.client as httplib
+    import urllib.parse as urlparse
+    import queue
+else:
+    import httplib
+    import urlparse
+    import Queue as queue
+
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class DownloadError(Exception):
+
+    def __init__(self, message, retry=True):
+        super(DownloadError, self).__init__(message)
+        self.retry = retry
+
+
+class RateLimiter(object):
+    """
+        Global limit of requests per second (token bucket shared by all threads)
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.rate is None:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class ConnectionPool(object):
+    """
+        Keep-alive connections grouped by (scheme, host), at most per_host connections are used at once
+    """
+
+    def __init__(self, per_host=4, timeout=10):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.limits = {}
+
+    def acquire(self, scheme, host):
+        key = (scheme, host)
+        with self.lock:
+            if key not in self.limits:
+                self.limits[key] = threading.BoundedSemaphore(self.per_host)
+                self.idle[key] = []
+            limit = self.limits[key]
+        limit.acquire()
+
+        with self.lock:
+            if self.idle[key]:
+                return self.idle[key].pop()
+        connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        return connection_class(host, timeout=self.timeout)
+
+    def release(self, scheme, host, connection, reuse=True):
+        key = (scheme, host)
+        if reuse:
+            with self.lock:
+                self.idle[key].append(connection)
+        else:
+            connection.close()
+        self.limits[key].release()
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = dict((key, []) for key in self.idle)
+
+
+class DownloadStats(object):
+    """
+        Thread-safe counters of downloaded files: statuses, bytes, throughput and failures per host
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.last_print = self.start
+        self.counts = {'ok' : 0, 'skipped' : 0, 'failed' : 0}
+        self.bytes = 0
+        self.failures_by_host = {}
+
+    def add(self, result):
+        with self.lock:
+            self.counts[result['status']] += 1
+            self.bytes += result['bytes']
+            if result['status'] == 'failed':
+                host = urlparse.urlsplit(result['url']).netloc
+                self.failures_by_host[host] = self.failures_by_host.get(host, 0) + 1
+
+    def report(self):
+        with self.lock:
+            elapsed = max(time.time() - self.start, 1e-6)
+            report = dict(self.counts)
+            report.update({'mb' : self.bytes / 1e6,
+                           'seconds' : elapsed,
+                           'files_per_s' : self.counts['ok'] / elapsed,
+                           'mb_per_s' : self.bytes / 1e6 / elapsed,
+                           'failures_by_host' : dict(self.failures_by_host)})
+            return report
+
+    def print_progress(self, every=5.):
+        with self.lock:
+            now = time.time()
+            if now - self.last_print < every:
+                return
+            self.last_print = now
+        report = self.report()
+        print ("Progress : ok {0}, skipped {1}, failed {2} : {3:.1f} files/s, {4:.2f} MB/s".format(
+               report['ok'], report['skipped'], report['failed'], report['files_per_s'], report['mb_per_s']))
+
+
+class Downloader(object):
+    """
+        Concurrent file downloader: thread pool, keep-alive connections (bounded per host),
+        per request timeout, retries with exponential backoff and global rate limit
+    """
+
+    def __init__(self, workers=16, per_host=4, timeout=10, retries=3, backoff=0.5, rate=None, max_redirects=5):
+        """
+            Args:
+                workers: int (number of download threads)
+                per_host: int (max number of simultaneous connections to one host)
+                timeout: float (seconds, connect/read timeout of each request)
+                retries: int (number of retries after failed attempt)
+                backoff: float (seconds, delay before retry n is backoff * 2 ** n)
+                rate: float (max number of requests per second, None - unlimited)
+                max_redirects: int
+        """
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.max_redirects = max_redirects
+        self.pool = ConnectionPool(per_host, timeout)
+        self.limiter = RateLimiter(rate)
+
+    def download(self, items, min_size=0, callback=None):
+        """
+            Download files concurrently
+            Args:
+                items: list of tuples (url, filename)
+                min_size: int (bytes, smaller files are skipped)
+                callback: callable(result) called from worker thread after each file (optional)
+
+            Returns:
+                list of dicts (url, filename, status: 'ok'/'skipped'/'failed', bytes, size, md5, error) 
+                in order of items
+        """
+        tasks = queue.Queue()
+        for i, item in enumerate(items):
+            tasks.put((i, item))
+
+        results = [None] * len(items)
+
+        def worker():
+            while True:
+                try:
+                    i, (url, filename) = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                results[i] = self.fetch(url, filename, min_size)
+                if callback is not None:
+                    callback(results[i])
+
+        threads = [threading.Thread(target=worker) for _ in range(max(1, min(self.workers, len(items))))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.pool.close()
+        return results
+
+    def fetch(self, url, filename, min_size=0):
+        """
+            Download single file with retries. Data is written to filename.part and renamed
+            when complete, an existing .part file is resumed with HTTP Range request
+            Returns:
+                dict (url, filename, status, bytes - downloaded by this call, size - file size, md5, error)
+        """
+        result = {'url' : url, 'filename' : filename, 'status' : 'failed', 'bytes' : 0, 
+                  'size' : None, 'md5' : None, 'error' : None}
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                saved = self._fetch(url, filename, min_size)
+                result['status'] = 'skipped' if saved is None else 'ok'
+                if saved is not None:
+                    result['bytes'], result['size'], result['md5'] = saved
+                result['error'] = None
+                return result
+            except (DownloadError) as error:
+                result['error'] = str(error)
+                if not error.retry:
+                    break
+            except (Exception) as error:
+                result['error'] = str(error)
+
+        print ('Fail to download : ' + url)
+        print (result['error'])
+        return result
+
+    def _fetch(self, url, filename, min_size=0):
+        temp = filename + '.part'
+        for _ in range(self.max_redirects + 1):
+            parsed = urlparse.urlsplit(url)
+            path = parsed.path or '/'
+            if parsed.query:
+                path += '?' + parsed.query
+
+            headers = {'Connection' : 'keep-alive'}
+            offset = os.path.getsize(temp) if os.path.exists(temp) else 0
+            if offset > 0:
+                headers['Range'] = 'bytes={0}-'.format(offset)
+
+            self.limiter.wait()
+            connection = self.pool.acquire(parsed.scheme, parsed.netloc)
+            reuse = False
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+
+                if response.status in REDIRECT_STATUSES:
+                    location = response.getheader('Location')
+                    response.read()
+                    reuse = not response.will_close
+                    if location is None:
+                        raise DownloadError("Redirect without location", retry=False)
+                    url = urlparse.urljoin(url, location)
+                    continue
+
+                if response.status == 416:
+                    # Partial file doesn't match remote one, start from scratch
+                    response.read()
+                    reuse = not response.will_close
+                    utils.rmfile(temp)
+                    raise DownloadError("HTTP 416 Range Not Satisfiable")
+
+                if response.status not in (200, 206):
+                    response.read()
+                    reuse = not response.will_close
+                    raise DownloadError("HTTP {0} {1}".format(response.status, response.reason),
+                                        retry=response.status in RETRY_STATUSES)
+
+                if response.status == 200:
+                    offset = 0
+                saved = self._save(response, url, filename, offset, min_size)
+                reuse = not response.will_close and response.isclosed()
+                return saved
+            finally:
+                self.pool.release(parsed.scheme, parsed.netloc, connection, reuse)
+
+        raise DownloadError("Too many redirects", retry=False)
+
+    def _save(self, response, url, filename, offset=0, min_size=0):
+        """
+            Write response body to filename.part (appending after offset bytes for 206 response)
+            and rename it to filename
+            Returns:
+                (bytes downloaded, file size, md5) or None if file is smaller than min_size
+        """
+        temp = filename + '.part'
+        length = response.getheader('Content-Length')
+        file_size = offset + int(length) if length else None
+
+        if file_size is not None and file_size < min_size:
+            print ("Skipped : {0} Bytes: {1} < {2}".format(url, file_size, min_size))
+            utils.rmfile(temp)
+            return None
+
+        if offset > 0:
+            print("Resuming: {0} Bytes: {1} from {2}".format(url, file_size, offset))
+        else:
+            print("Downloading: {0} Bytes: {1}".format(url, file_size))
+
+        md5 = hashlib.md5()
+        if offset > 0:
+            with open(temp, 'rb') as f:
+                for buf in iter(lambda: f.read(65536), b''):
+                    md5.update(buf)
+
+        file_size_dl = 0
+        block_sz = 65536
+        with open(temp, 'ab' if offset > 0 else 'wb') as f:
+            while True:
+                buf = response.read(block_sz)
+                if not buf:
+                    break
+                file_size_dl += len(buf)
+                md5.update(buf)
+                f.write(buf)
+
+        total = offset + file_size_dl
+        if file_size is not None and total != file_size:
+            # Keep partial file, next attempt resumes it
+            raise DownloadError("Truncated : {0} of {1} bytes".format(total, file_size))
+
+        if total < min_size:
+            print ("Skipped : {0} Bytes: {1} < {2}".format(url, total, min_size))
+            utils.rmfile(temp)
+            return None
+
+        os.rename(temp, filename)
+        return file_size_dl, total, md5.hexdigest()
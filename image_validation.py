@@ -0,0 +1,236 @@
+import os
+import json
+import struct
+
+import cv2
+import numpy as np
+
+import parsers
+import utils
+from manifest import DownloadManifest, MANIFEST_FILENAME
+
+INDEX_FILENAME = '.image_index.json'
+REPORT_FILENAME = '.validation_report.json'
+
+JPEG_MAGIC = b'\xff\xd8\xff'
+JPEG_EOI = b'\xff\xd9'
+# End of image marker is searched in the tail of file, some servers append bytes after it
+EOI_SEARCH_BYTES = 4096
+# Start of frame markers (baseline, progressive, ...) that hold image size
+SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+
+def _jpeg_size(f):
+    """
+        Read image size from JPEG header without decoding (walks segments up to start of frame)
+        Args:
+            f: file opened in binary mode, positioned after SOI marker
+        Returns:
+            (width, height)
+    """
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0:1] != b'\xff':
+            raise ValueError("broken segment")
+        code = ord(marker[1:2])
+        if code == 0xFF:
+            # Padding byte, marker follows
+            f.seek(-1, os.SEEK_CUR)
+            continue
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            raise ValueError("broken segment")
+        length = struct.unpack('>H', length)[0]
+        if code in SOF_MARKERS:
+            data = f.read(5)
+            if len(data) < 5:
+                raise ValueError("broken frame header")
+            height, width = struct.unpack('>HH', data[1:5])
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+def _dhash(filename, size=8):
+    """
+        Difference hash (64 bits): image is reduced to gray (size + 1) x size,
+        each bit tells whether pixel is brighter than its right neighbour
+    """
+    image = cv2.imread(filename, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None:
+        return None
+    image = cv2.resize(image, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (image[:, 1:] > image[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+def check_image(filename, min_width=32, min_height=32):
+    """
+        Cheap content check of downloaded image
+        Returns:
+            dict (status: 'ok'/'rejected', reason, width, height, hash - hex string of dhash)
+    """
+    result = {'status' : 'rejected', 'reason' : None, 'width' : None, 'height' : None, 'hash' : None}
+    try:
+        with open(filename, 'rb') as f:
+            if f.read(3) != JPEG_MAGIC:
+                result['reason'] = 'not_jpeg'
+                return result
+            f.seek(2)
+            width, height = _jpeg_size(f)
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - EOI_SEARCH_BYTES))
+            if JPEG_EOI not in f.read():
+                result['reason'] = 'truncated'
+                return result
+    except (Exception):
+        result['reason'] = 'broken_header'
+        return result
+
+    result['width'], result['height'] = width, height
+    if width < min_width or height < min_height:
+        result['reason'] = 'too_small'
+        return result
+
+    image_hash = _dhash(filename)
+    if image_hash is None:
+        result['reason'] = 'undecodable'
+        return result
+
+    result['status'], result['hash'] = 'ok', '{0:016x}'.format(image_hash)
+    return result
+
+def _check_files(task):
+    files, min_width, min_height = task
+    return [check_image(fl, min_width, min_height) for fl in files]
+
+def _hamming(value, values):
+    """
+        Number of different bits between value (uint64) and each of values (uint64 array)
+    """
+    xor = np.bitwise_xor(values, np.uint64(value))
+    return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+def _find_duplicates(names, hashes, max_distance=0):
+    """
+        Group images with (nearly) equal hashes, first name (sorted) of each group is kept
+        Returns:
+            dict name -> name of kept image
+    """
+    duplicates = {}
+    order = np.argsort(names)
+    names = [names[i] for i in order]
+    hashes = np.array([int(hashes[i], 16) for i in order], dtype=np.uint64)
+
+    if max_distance <= 0:
+        first = {}
+        for name, h in zip(names, hashes):
+            if h in first:
+                duplicates[name] = first[h]
+            else:
+                first[h] = name
+        return duplicates
+
+    removed = np.zeros(len(names), dtype=bool)
+    for i in range(len(names)):
+        if removed[i]:
+            continue
+        similar = np.nonzero(_hamming(hashes[i], hashes[i + 1:]) <= max_distance)[0] + i + 1
+        for j in similar:
+            if not removed[j]:
+                removed[j] = True
+                duplicates[names[j]] = names[i]
+    return duplicates
+
+def _load_json(filename):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+def _save_json(data, filename):
+    temp = filename + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.rename(temp, filename)
+
+def validate(folder, workers=None, remove=False, placeholders=(), max_distance=0, min_width=32, min_height=32,
+             chunk_size=200):
+    """
+        Validate images of folder: JPEG magic bytes and header, perceptual hash based
+        deduplication and placeholder detection. Results of each file are kept in index
+        (keyed by file mtime and size), so next run checks only new or changed files
+        Args:
+            folder: dirname with *.jpg images
+            workers: int (number of processes, None - number of cpus)
+            remove: bool (delete rejected images, they are marked rejected in download manifest of folder)
+            placeholders: list of hex hashes (or image filenames) of known placeholder images
+                          (e.g. 'photo unavailable')
+            max_distance: int (max number of different hash bits for duplicates/placeholders)
+            min_width, min_height: int (smaller images are rejected)
+            chunk_size: int (number of images checked by one task)
+
+        Returns:
+            report: dict (checked, ok, rejected - dict filename -> reason)
+    """
+    folder = os.path.abspath(folder)
+    index_file = os.path.join(folder, INDEX_FILENAME)
+    index = _load_json(index_file)
+
+    stats = {}
+    for fl in parsers.list_files(folder, '.jpg'):
+        st = os.stat(fl)
+        stats[os.path.basename(fl)] = [st.st_mtime, st.st_size]
+
+    # Forget removed files, check new or changed ones
+    index = dict((name, entry) for name, entry in index.items() if name in stats)
+    todo = sorted(name for name in stats if name not in index or index[name]['stat'] != stats[name])
+
+    chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+    tasks = [([os.path.join(folder, name) for name in chunk], min_width, min_height) for chunk in chunks]
+    for chunk, results in zip(chunks, utils.map_parallel(_check_files, tasks, workers)):
+        for name, result in zip(chunk, results):
+            result['stat'] = stats[name]
+            index[name] = result
+
+    # Content checks are per file, duplicates and placeholders depend on the whole folder
+    rejected = dict((name, entry['reason']) for name, entry in index.items() if entry['status'] != 'ok')
+    valid = sorted(name for name, entry in index.items() if entry['status'] == 'ok')
+
+    placeholder_hashes = []
+    for placeholder in placeholders:
+        if os.path.exists(placeholder):
+            placeholder = check_image(placeholder, 0, 0)['hash']
+        if placeholder is not None:
+            placeholder_hashes.append(int(placeholder, 16))
+    placeholder_hashes = np.array(placeholder_hashes, dtype=np.uint64)
+
+    unique = []
+    for name in valid:
+        h = int(index[name]['hash'], 16)
+        if len(placeholder_hashes) > 0 and np.min(_hamming(h, placeholder_hashes)) <= max_distance:
+            rejected[name] = 'placeholder'
+        else:
+            unique.append(name)
+
+    duplicates = _find_duplicates(unique, [index[name]['hash'] for name in unique], max_distance)
+    for name, original in duplicates.items():
+        rejected[name] = 'duplicate:{0}'.format(original)
+
+    if remove:
+        for name in rejected:
+            utils.rmfile(os.path.join(folder, name))
+            index.pop(name, None)
+        manifest_file = os.path.join(folder, MANIFEST_FILENAME)
+        if len(rejected) > 0 and os.path.exists(manifest_file):
+            DownloadManifest(manifest_file).reject(rejected)
+
+    _save_json(index, index_file)
+    report = {'folder' : folder,
+              'checked' : len(todo),
+              'total' : len(stats),
+              'ok' : len(stats) - len(rejected),
+              'rejected' : rejected}
+    _save_json(report, os.path.join(folder, REPORT_FILENAME))
+
+    print ("Validated {0} : checked {1} of {2}, rejected {3}".format(folder, len(todo), len(stats), len(rejected)))
+    return report
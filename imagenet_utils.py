@@ -1,42 +1,156 @@
 import sys
 import os
-import time
-import tarfile
-import shutil
-import cv2
 import parsers
-import random
+import relabel
 import common
 import utils
+import image_validation
+import threading
+import itertools
+from downloader import Downloader, DownloadStats
+from manifest import DownloadManifest, MANIFEST_FILENAME
 
 
 if sys.version_info >= (3,):
     import urllib.request as urllib2
     import urllib.parse as urlparse
+    import queue
 else:
     import urllib2
     import urlparse
     import urllib
+    import Queue as queue
 
 min_image_size = 10 * 1024
 
 
 class ImageNetLoader(object):
 
-    def __init__(self):        
+    def __init__(self, downloader=None, timeout=30):        
+        """
+            Args:
+                downloader: downloader.Downloader used for images (optional)
+                timeout: float (seconds, timeout of api and annotation requests)
+        """
+        self.downloader = downloader if downloader is not None else Downloader()
+        self.timeout = timeout
         self.host = "http://www.image-net.org"
         self.images      = "{0}{1}".format(self.host, '/api/text/imagenet.synset.geturls?wnid=')
         self.mappings    = "{0}{1}".format(self.host, '/api/text/imagenet.synset.geturls.getmapping?wnid=')
         self.annotations = "{0}{1}".format(self.host, '/downloads/bbox/bbox/')
         self.names       = "{0}{1}".format(self.host, '/api/text/wordnet.synset.getwords?wnid=')
 
-    def download(self, class_ids, folder='.', params={}):
+    def download(self, class_ids, folder='.', params={}, workers=1):
+        """
+            Download classes (synsets)
+            Args:
+                class_ids: list of wordnet ids
+                folder: dirname where images/ and annotations/ are created
+                params: dict (images, boxes, set_name, validate - bool,
+                        placeholders - hashes or filenames of placeholder images, see image_validation.validate)
+                workers: int (1 - classes one after another,
+                         N - all stages of all classes run as tasks on N threads, see _download_parallel)
+
+            Returns:
+                maps: dict class_id -> class_name
+        """
+        if workers > 1:
+            return self._download_parallel(class_ids, folder, params, workers)
+
         maps = {}
         for class_id in class_ids:
             print ("Downloading {0}".format(class_id))
             class_name = self._download_single(class_id, folder, params)
             maps[class_id] = class_name
         return maps
+
+    def _download_parallel(self, class_ids, folder='.', params={}, workers=16, report_every=5.):
+        """
+            Task graph over all classes executed by one pool of workers (global concurrency budget):
+                name, urls, mappings -> annotations (-> set_name)
+                name, urls, mappings -> images (one task per file)
+            Metadata tasks have priority over images, so image queue is filled as early as possible.
+            Progress (files/s, MB/s, failures per host) is printed every report_every seconds,
+            final report is stored to self.last_report
+        """
+        folder = os.path.abspath(folder)
+        stats = DownloadStats()
+        graph = _TaskGraph(workers)
+
+        classes = dict((class_id, {'name' : None, 'urls' : None, 'mappings' : None, 'pending' : 3, 
+                                   'images' : 0, 'manifest' : None}) for class_id in class_ids)
+        lock = threading.Lock()
+
+        def meta_done(class_id, key, value):
+            with lock:
+                state = classes[class_id]
+                state[key] = value
+                state['pending'] -= 1
+                ready = state['pending'] == 0
+            if ready:
+                graph.add(0, schedule_class, class_id)
+
+        def schedule_class(class_id):
+            state = classes[class_id]
+            if state['name'] is None:
+                state['name'] = class_id
+            print ("Class name - {0}".format(state['name']))
+
+            if params.get('boxes'):
+                graph.add(0, annotations, class_id)
+            if params.get('images') and state['urls'] is not None:
+                output = utils.make_dir(os.path.join(folder, 'images', state['name']))
+                items = self._image_items(state['urls'], state['mappings'], output)
+                manifest = DownloadManifest(os.path.join(output, MANIFEST_FILENAME))
+                items = manifest.plan(items)
+                with lock:
+                    state['manifest'], state['images'] = manifest, len(items)
+                for url, filename in items:
+                    graph.add(1, image, class_id, url, filename)
+                if len(items) == 0:
+                    images_done(class_id)
+
+        def images_done(class_id):
+            state = classes[class_id]
+            state['manifest'].save()
+            print ("Done {0}".format(state['name']))
+            if params.get('validate'):
+                graph.add(0, image_validation.validate, os.path.join(folder, 'images', state['name']), 1, True,
+                          params.get('placeholders') or ())
+
+        def annotations(class_id):
+            class_name = classes[class_id]['name']
+            annotations_dir = self.download_annotations(class_id, folder, class_name)
+            if params.get('set_name') and class_name != class_id:
+                relabel.relabel(os.path.join(annotations_dir, class_name), class_name=class_name, workers=1,
+                                update_index=True)
+
+        def image(class_id, url, filename):
+            result = self.downloader.fetch(url, filename, min_image_size)
+            stats.add(result)
+            state = classes[class_id]
+            state['manifest'].update(result)
+            with lock:
+                state['images'] -= 1
+                finished = state['images'] == 0
+            if finished:
+                images_done(class_id)
+            stats.print_progress(report_every)
+
+        for class_id in class_ids:
+            print ("Downloading {0}".format(class_id))
+            graph.add(0, lambda c: meta_done(c, 'name', self.get_class_name(c)), class_id)
+            graph.add(0, lambda c: meta_done(c, 'urls', self.download_urls(c) if params.get('images') else None), class_id)
+            graph.add(0, lambda c: meta_done(c, 'mappings', self.download_mappings(c) if params.get('images') else None), class_id)
+
+        graph.run()
+        self.downloader.pool.close()
+
+        self.last_report = stats.report()
+        print ("Downloaded {0} files ({1:.1f} MB) : {2:.1f} files/s, {3:.2f} MB/s, failures by host {4}".format(
+               self.last_report['ok'], self.last_report['mb'], self.last_report['files_per_s'], 
+               self.last_report['mb_per_s'], self.last_report['failures_by_host']))
+        return dict((class_id, state['name']) for class_id, state in classes.items())
         
     def _download_single(self, class_id, folder='.', params={}):
         folder = os.path.abspath(folder)
@@ -52,18 +166,20 @@ class ImageNetLoader(object):
             annotations_dir = self.download_annotations(class_id, folder, class_name)
             if 'set_name' in params.keys() and params['set_name'] and class_name != class_id:
                 print (annotations_dir,  class_name)
-                files = parsers.list_files(os.path.join(annotations_dir, class_name), '.xml')
-                parsers.set_object_name(files, class_name)
+                relabel.relabel(os.path.join(annotations_dir, class_name), class_name=class_name, update_index=True)
 
         if 'images' in params.keys() and params['images']:
-            self.download_images(class_id, folder, class_name)
+            images_dir = self.download_images(class_id, folder, class_name)
+            if params.get('validate') and images_dir:
+                image_validation.validate(os.path.join(images_dir, class_name), remove=True,
+                                          placeholders=params.get('placeholders') or ())
 
         return class_name    
 
     def get_class_name(self, class_id):
         url = self.names + class_id
         try:
-            response = urllib2.urlopen(url)   
+            response = urllib2.urlopen(url, timeout=self.timeout)   
             name     = response.read().decode('utf-8')
             return name.rstrip()
         except (Exception) as error:
@@ -72,46 +188,46 @@ class ImageNetLoader(object):
         return None
 
     def download_annotations(self, class_id, folder='.', class_name=None, force=False):
-
+        """
+            Download box annotations archive and extract it while downloading:
+            members Annotation/<class_id>/*.xml are written straight to annotations/<class_name>,
+            no temporary archive or folders, no chdir (safe to call from many threads)
+        """
         folder = utils.make_dir(os.path.abspath(os.path.join(folder, "annotations")))
         if force:
             utils.rmdir(os.path.join(folder, class_id))
-            utils.rmdir(os.path.join(folder, class_name))
+            if class_name is not None:
+                utils.rmdir(os.path.join(folder, class_name))
 
-        temp_folder = utils.make_dir(os.path.join(folder, 'temp'))
-        
         filename = str(class_id) + '.tar.gz'
         url = self.annotations + filename
+        output = os.path.join(folder, class_name if class_name is not None else class_id)
 
         try:
-            filename = os.path.join(temp_folder, filename)
-            utils.download_file(url, filename)            
-        
-            current_dir = os.getcwd()
-            os.chdir(temp_folder)
-
-            utils.extract_tar_file(filename)
-            print ("Extracted to folder {0}".format(folder))
-            os.chdir(current_dir)
-
-            shutil.move('{0}/Annotation/{1}'.format(temp_folder, class_id), folder)
-
-            output = '{0}/{1}'.format(folder, class_id)
-            if class_name is not None:
-                name_output = '{0}/{1}'.format(folder, class_name)
-                os.rename(output, name_output)
-                output = name_output
-
-            print ('Download box annotation from ' + url + ' to ' + output)
+            response = urllib2.urlopen(url, timeout=self.timeout)
+            count = utils.extract_tar_stream(response, output, prefix='Annotation/{0}/'.format(class_id))
+            print ('Download box annotation ({0} files) from {1} to {2}'.format(count, url, output))
         except (Exception) as error:
             print (error)
             print ('Fail to download ' + url)  
 
-        shutil.rmtree(temp_folder) 
         return folder
 
+    def stream_annotations(self, class_id):
+        """
+            Download box annotations and parse them in memory, nothing is written to disk
+            Yields:
+                (annotation filename, [image filename, bounding boxes]) - see parsers.parse_from_pascal_voc_format
+        """
+        url = self.annotations + str(class_id) + '.tar.gz'
+        response = urllib2.urlopen(url, timeout=self.timeout)
+        for name, data in utils.iter_tar_stream(response, prefix='Annotation/{0}/'.format(class_id)):
+            try:
+                yield name, parsers.parse_from_pascal_voc_string(data)
+            except (Exception) as error:
+                print ("Error parsing {0} : {1}".format(name, error))
+
     def download_images(self, class_id, folder='.', class_name=None, with_maps=True, force=False):
-        #TODO possible check on image content
         folder = utils.make_dir(os.path.abspath(os.path.join(folder, "images")))
         if force:
             utils.rmdir(os.path.join(folder, class_id))
@@ -133,9 +249,29 @@ class ImageNetLoader(object):
             if mappings is None:
                 with_maps = False
             
-        cnt = 0
+        items = self._image_items(urls, mappings if with_maps else None, output)
+
+        # Manifest keeps state of each url, so re-run downloads only missing or failed files
+        manifest = DownloadManifest(os.path.join(output, MANIFEST_FILENAME))
+        items = manifest.plan(items)
+
+        results = self.downloader.download(items, min_size=min_image_size, callback=manifest.update)
+        manifest.save()
+        cnt = len([r for r in results if r['status'] == 'ok'])
+        print ("Done. {0} saved".format(cnt))
+        return folder
+
+
+    def _image_items(self, urls, mappings, output):
+        """
+            Target filename for each url: <mapping>.jpg when mappings are given 
+            (urls without mapping are skipped), url basename otherwise
+            Returns:
+                list of tuples (url, filename)
+        """
+        items = []
         for url in urls:
-            if with_maps: 
+            if mappings is not None: 
                 if url in mappings.keys():
                     filename = mappings[url] + '.jpg'
                 else:               
@@ -143,18 +279,13 @@ class ImageNetLoader(object):
             else:
                 filename = os.path.basename(url)
 
-            filename = os.path.join(output, filename)
-            if not os.path.exists(filename):
-                if self._download_image(url, filename):
-                    cnt += 1    
-        print ("Done. {0} saved".format(cnt))
-        return folder
-
+            items.append((url, os.path.join(output, filename)))
+        return items
 
     def download_urls(self, class_id ):
         url = self.images + class_id
         try:
-            response = urllib2.urlopen(url)  
+            response = urllib2.urlopen(url, timeout=self.timeout)  
             contents = response.read().decode('utf-8').split('\n')
             image_url = []
             for each_line in contents:
@@ -173,7 +304,7 @@ class ImageNetLoader(object):
         url = self.mappings + class_id
         try:
 
-            response = urllib2.urlopen(url)   
+            response = urllib2.urlopen(url, timeout=self.timeout)   
             contents = response.read().decode('utf-8').split('\n')     
             mappings = {}
 
@@ -193,14 +324,44 @@ class ImageNetLoader(object):
             print (str(error))
         return None   
 
-    def _download_image(self, url, filename):
-        try:
-            utils.download_file(url, filename, min_size=min_image_size)
-            return True
-        except (Exception) as error:
-            print ('Fail to download : ' + url)
-            print (str(error))
-            return False
+class _TaskGraph(object):
+    """
+        Tasks with priorities executed by fixed number of threads, 
+        running task may add new tasks (dependent stages)
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.tasks = queue.PriorityQueue()
+        self.counter = itertools.count()
+
+    def add(self, priority, func, *args):
+        self.tasks.put((priority, next(self.counter), func, args))
+
+    def run(self):
+        threads = [threading.Thread(target=self._worker) for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # Task is done only after its followers were added, so join waits for the whole graph
+        self.tasks.join()
+        for _ in threads:
+            self.tasks.put((sys.maxsize, next(self.counter), None, None))
+        for thread in threads:
+            thread.join()
+
+    def _worker(self):
+        while True:
+            _, _, func, args = self.tasks.get()
+            if func is None:
+                self.tasks.task_done()
+                return
+            try:
+                func(*args)
+            except (Exception) as error:
+                print (error)
+            finally:
+                self.tasks.task_done()
 
 def visualize_data(class_name, folder='.', filename=None):
     folder = os.path.abspath(folder)
@@ -0,0 +1,114 @@
+import os
+import json
+import threading
+
+MANIFEST_FILENAME = '.manifest.json'
+# rejected - removed by image_validation.validate (placeholder, duplicate, broken image)
+DONE_STATUSES = ('ok', 'skipped', 'rejected')
+
+
+class DownloadManifest(object):
+    """
+        Record of downloads of one class: url -> filename, size, status, md5, error.
+        Finished entries (ok, skipped, rejected) are not downloaded again on next runs, planning only lists
+        folders to find ok files deleted since (one os.listdir per folder)
+    """
+
+    def __init__(self, filename, save_every=100):
+        """
+            Args:
+                filename: manifest file (*.json)
+                save_every: int (save manifest after each N updates, so crash loses at most N entries)
+        """
+        self.filename = os.path.abspath(filename)
+        self.save_every = save_every
+        self.lock = threading.Lock()
+        self.updates = 0
+        self.entries = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as f:
+                self.entries = json.load(f)
+
+    def plan(self, items):
+        """
+            Select items that have to be downloaded (new, pending or failed entries)
+            Files that exist but are not in manifest (downloaded before manifest) are recorded as ok,
+            ok entries whose files were deleted are planned again
+            Args:
+                items: list of tuples (url, filename)
+
+            Returns:
+                list of tuples (url, filename)
+        """
+        todo, listed = [], {}
+
+        def exists(filename):
+            folder, name = os.path.split(os.path.abspath(filename))
+            if folder not in listed:
+                listed[folder] = set(os.listdir(folder)) if os.path.isdir(folder) else set()
+            return name in listed[folder]
+
+        with self.lock:
+            for url, filename in items:
+                entry = self.entries.get(url)
+                if entry is None:
+                    if exists(filename):
+                        entry = {'status' : 'ok', 'size' : os.path.getsize(filename), 'md5' : None}
+                    else:
+                        entry = {'status' : 'pending', 'size' : None, 'md5' : None}
+                    entry['filename'] = os.path.basename(filename)
+                    entry['error'] = None
+                    self.entries[url] = entry
+                elif entry['status'] == 'ok' and not exists(filename):
+                    entry.update({'status' : 'pending', 'size' : None, 'md5' : None, 'error' : None})
+
+                if entry['status'] not in DONE_STATUSES:
+                    todo.append((url, filename))
+        self.save()
+        print ("Planned {0} of {1} files".format(len(todo), len(items)))
+        return todo
+
+    def update(self, result):
+        """
+            Record result of downloader.Downloader.fetch
+        """
+        with self.lock:
+            self.entries[result['url']] = {'filename' : os.path.basename(result['filename']),
+                                           'status' : result['status'],
+                                           'size' : result['size'],
+                                           'md5' : result['md5'],
+                                           'error' : result['error']}
+            self.updates += 1
+            save = self.updates % self.save_every == 0
+        if save:
+            self.save()
+
+    def reject(self, reasons):
+        """
+            Mark entries of files rejected and removed by validation, so they are not downloaded again
+            Args:
+                reasons: dict file basename -> reason
+        """
+        with self.lock:
+            for entry in self.entries.values():
+                if entry['filename'] in reasons:
+                    entry['status'], entry['error'] = 'rejected', reasons[entry['filename']]
+        self.save()
+
+    def summary(self):
+        with self.lock:
+            summary = {}
+            for entry in self.entries.values():
+                summary[entry['status']] = summary.get(entry['status'], 0) + 1
+            return summary
+
+    def save(self):
+        """
+            Save manifest atomically (write to temp file and rename)
+        """
+        with self.lock:
+            temp = self.filename + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.rename(temp, self.filename)
+        return self.filename
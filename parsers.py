@@ -1,7 +1,9 @@
 import xml.etree.cElementTree as etree
 import numpy as np
 import os
+import io
 import glob
+import utils
 
 def list_files(folder, file_format='.jpg'):
     """
@@ -17,6 +19,53 @@ def list_files(folder, file_format='.jpg'):
     filenames = glob.glob(pattern)    
     return filenames
 
+def index_files(folder, file_format='.jpg'):
+    """
+        One directory pass: names (without extension) of files of specific format
+        Returns:
+            dict name -> full path
+    """
+    names = {}
+    if not os.path.isdir(folder):
+        return names
+    
+    if hasattr(os, 'scandir'):
+        cut = len(file_format)
+        for entry in os.scandir(folder):
+            if entry.name.endswith(file_format):
+                names[entry.name[:-cut]] = entry.path
+        return names
+
+    for filename in os.listdir(folder):
+        if filename.endswith(file_format):
+            names[filename[:-len(file_format)]] = os.path.join(folder, filename)
+    return names
+
+def pair_files(annotations_folder, images_folder, annotation_format='.xml', image_format='.jpg'):
+    """
+        Match annotations with images by filename (without extension) in linear time
+        Args:
+            annotations_folder: dirname with annotations
+            images_folder: dirname with images
+            annotation_format, image_format: file extensions
+
+        Returns:
+            pairs: list of tuples (annotation, image) - full paths, sorted by name
+            orphan_annotations: list of annotations without image
+            orphan_images: list of images without annotation
+    """
+    annotations = index_files(annotations_folder, annotation_format)
+    images = index_files(images_folder, image_format)
+
+    pairs, orphan_annotations = [], []
+    for name in sorted(annotations):
+        if name in images:
+            pairs.append((annotations[name], images[name]))
+        else:
+            orphan_annotations.append(annotations[name])
+    orphan_images = [images[name] for name in sorted(images) if name not in annotations]
+    return pairs, orphan_annotations, orphan_images
+
 def parse_from_pascal_voc_format(filename):
     """
         Look to Pascal VOC 2007 XML format http://host.robots.ox.ac.uk/pascal/VOC/voc2007/guidelines.html
@@ -27,8 +76,8 @@ def parse_from_pascal_voc_format(filename):
             Bounding box: ints xmin, ymin, xmax, ymax - 
                           represents bounding box corners coordinates
     """
-    in_file = open(filename)
-    tree=etree.parse(in_file)
+    with open(filename) as in_file:
+        tree=etree.parse(in_file)
     root = tree.getroot()
 
     image_filename = root.find('filename').text
@@ -41,34 +90,133 @@ def parse_from_pascal_voc_format(filename):
         xx = int(float(xmlbox.find('xmax').text))
         yn = int(float(xmlbox.find('ymin').text))
         yx = int(float(xmlbox.find('ymax').text))
-        in_file.close()
 
         bboxes.append([xn, yn, xx, yx])        
     return [image_filename, bboxes]
 
-def set_object_name(files, class_name):
-    if len(files) <= 0:
-        print ("Files can't be empty")
-        return
-    
-    for fl in files:
-        tree = etree.ElementTree(file=fl)
-        root = tree.getroot()   
+def parse_from_pascal_voc_string(data):
+    """
+        Same as parse_from_pascal_voc_format for annotation content already in memory
+        Args:
+            data: bytes or string with data according to Pascal VOC 2007 XML format
+    """
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    image_filename, _, bboxes = _parse_voc_stream(io.BytesIO(data))
+    return [image_filename, bboxes]
+
+def _parse_voc_stream(filename):
+    """
+        Streaming (iterparse) version of parse_from_pascal_voc_format, 
+        elements are released as soon as they are read
+        Args:
+            filename: *.xml file or file-like object
+        Returns:
+            image_filename: string
+            names: list of object class names
+            bboxes: list of [xmin, ymin, xmax, ymax]
+    """
+    image_filename, names, bboxes = None, [], []
+    for _, elem in etree.iterparse(filename, events=('end',)):
+        if elem.tag == 'filename':
+            image_filename = elem.text
+        elif elem.tag == 'object':
+            xmlbox = elem.find('bndbox')
+            bboxes.append([int(float(xmlbox.find(tag).text)) for tag in ('xmin', 'ymin', 'xmax', 'ymax')])
+            names.append(elem.findtext('name', ''))
+            elem.clear()
+    if image_filename is None:
+        raise ValueError("filename not found")
+    return image_filename, names, bboxes
 
-        image_filename = root.find('filename').text
-        if not image_filename.endswith('.jpg'):
-            root.find('filename').text = image_filename + '.jpg'
-        for obj in root.iter('object'):       
-            if class_name != '':     
-                obj.find('name').text = class_name        
+def _parse_files(files):
+    """
+        Parse list of annotation files into columns, class ids are local to this list
+    """
+    images, errors, classes = [], [], {}
+    file_index, class_ids, bboxes = [], [], []
+    for i, fl in enumerate(files):
+        try:
+            image_filename, names, boxes = _parse_voc_stream(fl)
+        except (Exception) as error:
+            images.append(None)
+            errors.append((fl, str(error)))
+            continue
 
-        tree=etree.ElementTree(root)
-        tree.write(fl)     
-       
-    print ("Changed object names {0}".format(len(files)))
+        images.append(image_filename)
+        for name, box in zip(names, boxes):
+            file_index.append(i)
+            class_ids.append(classes.setdefault(name, len(classes)))
+            bboxes.append(box)
 
+    names = sorted(classes, key=classes.get)
+    return images, errors, names, file_index, class_ids, bboxes
+
+def parse_bulk(source, workers=None, chunk_size=1000):
+    """
+        Parse many Pascal VOC annotations at once on a process pool
+        Args:
+            source: dirname with *.xml files or list of *.xml files
+            workers: int (number of processes, None - number of cpus)
+            chunk_size: int (number of files parsed by one task)
+
+        Returns:
+            dict with keys
+                files: list of annotation filenames
+                images: list of image filenames for each annotation (None if malformed)
+                classes: list of class names
+                file_index, class_id, xmin, ymin, xmax, ymax: int32 arrays, one element per bounding box
+                errors: list of tuples (filename, error message) for malformed files
+    """
+    if isinstance(source, (list, tuple)):
+        files = list(source)
+    else:
+        files = list_files(source, '.xml')
+
+    chunks = [files[i:i + chunk_size] for i in range(0, len(files), chunk_size)]
+    parts = utils.map_parallel(_parse_files, chunks, workers)
+    return _merge_parts(files, parts, chunk_size)
+
+def _merge_parts(files, parts, chunk_size):
+    """
+        Merge results of _parse_files (one part per chunk of files) into parse_bulk columns
+    """
+    images, errors, classes = [], [], {}
+    file_index, class_ids, bboxes = [], [], []
+    for n, part in enumerate(parts):
+        part_images, part_errors, part_names, part_file_index, part_class_ids, part_bboxes = part
+        mapping = np.array([classes.setdefault(name, len(classes)) for name in part_names], dtype=np.int32)
+
+        images.extend(part_images)
+        errors.extend(part_errors)
+        file_index.append(np.asarray(part_file_index, dtype=np.int32) + n * chunk_size)
+        class_ids.append(mapping[np.asarray(part_class_ids, dtype=np.int32)])
+        bboxes.append(np.asarray(part_bboxes, dtype=np.int32).reshape(-1, 4))
+
+    bboxes = np.concatenate(bboxes) if bboxes else np.zeros((0, 4), dtype=np.int32)
+    for fl, error in errors:
+        print ("Error parsing {0} : {1}".format(fl, error))
+
+    return {'files' : files,
+            'images' : images,
+            'classes' : sorted(classes, key=classes.get),
+            'file_index' : np.concatenate(file_index) if file_index else np.zeros(0, dtype=np.int32),
+            'class_id' : np.concatenate(class_ids) if class_ids else np.zeros(0, dtype=np.int32),
+            'xmin' : bboxes[:, 0],
+            'ymin' : bboxes[:, 1],
+            'xmax' : bboxes[:, 2],
+            'ymax' : bboxes[:, 3],
+            'errors' : errors}
+
+def set_object_name(files, class_name):
+    """
+        Set name of every object (class_name '' - keep names) and add .jpg to image filenames,
+        see relabel.set_object_name
+    """
+    # Imported here, relabel depends on parsers
+    import relabel
+    return relabel.set_object_name(files, class_name)
 
-    
 #TODO maybe remove 
 def parse_from_json_darkflow_format(data):
     """
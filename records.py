@@ -0,0 +1,271 @@
+import os
+import json
+
+import numpy as np
+
+import parsers
+import split_tt
+import utils
+
+RECORDS_SUFFIX = '.records.json'
+ENCODINGS = ('jpg', 'raw')
+
+
+def _split_files(source, subset='train', folder='.'):
+    """
+        Annotations of subset and images they may refer to
+        Args:
+            source: split manifest (dict or *.tsv, see split_tt.split_stratified) or
+                    folder created by split_tt.split_all (<source>/<subset>/annotations and images folders,
+                    or annotations.txt and images.txt lists of 'manifest' mode)
+            folder: dirname manifest paths are relative to
+        Returns:
+            annotations: list of *.xml filenames
+            images: dict image basename -> image filename
+    """
+    if isinstance(source, dict) or os.path.isfile(source):
+        annotations, images = split_tt.select(source, subset, folder=folder)
+        return annotations, dict((os.path.basename(fl), fl) for fl in images)
+
+    subset_folder = os.path.join(os.path.abspath(source), subset)
+    lists = [os.path.join(subset_folder, name + '.txt') for name in ('annotations', 'images')]
+    if all(os.path.exists(fl) for fl in lists):
+        annotations, images = [_read_lines(fl) for fl in lists]
+        return annotations, dict((os.path.basename(fl), fl) for fl in images)
+
+    annotations = parsers.list_files(os.path.join(subset_folder, 'annotations'), '.xml')
+    images = parsers.index_files(os.path.join(subset_folder, 'images'), '.jpg')
+    return annotations, dict((name + '.jpg', fl) for name, fl in images.items())
+
+def _subsets(source):
+    if isinstance(source, dict) or os.path.isfile(source):
+        manifest = source if isinstance(source, dict) else split_tt.read_manifest(source)
+        return [name for name, _ in manifest['ratios']]
+    source = os.path.abspath(source)
+    return sorted(name for name in os.listdir(source) if os.path.isdir(os.path.join(source, name)))
+
+def _labels(source, folder='.', workers=None):
+    """
+        Sorted class names of all subsets, so every subset packed from source has the same class ids
+    """
+    labels = set()
+    for subset in _subsets(source):
+        annotations, _ = _split_files(source, subset, folder)
+        if len(annotations) > 0:
+            labels.update(parsers.parse_bulk(annotations, workers)['classes'])
+    return sorted(labels)
+
+def _read_lines(filename):
+    with open(filename, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+def _shard_name(subset, shard, shards):
+    return '{0}-{1:05d}-of-{2:05d}'.format(subset, shard, shards)
+
+def _encode(filename, boxes, resize=None, encoding='jpg', quality=95):
+    """
+        Returns:
+            (data - bytes, boxes in stored image coordinates, original (h, w))
+    """
+    if resize is None:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        import cv2
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("can't decode image")
+        return data, boxes, image.shape[:2]
+
+    import cv2
+    image = cv2.imread(filename, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("can't decode image")
+    h, w = image.shape[:2]
+    image = cv2.resize(image, tuple(resize))
+    scale = np.array([resize[0] / float(w), resize[1] / float(h)] * 2)
+    boxes = np.round(boxes * scale).astype(np.int32)
+    if encoding == 'raw':
+        return image.tobytes(), boxes, (h, w)
+    return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes(), boxes, (h, w)
+
+def _pack_shard(task):
+    """
+        Write one shard: <name>.rec (images one after another) and <name>.idx.npz (offsets, boxes, ...)
+    """
+    filename, samples, resize, encoding, quality = task
+    offsets, lengths, box_offsets, sizes, names = [0], [], [0], [], []
+    boxes, class_ids, errors = [], [], []
+
+    temp = filename + '.rec.tmp'
+    with open(temp, 'wb') as f:
+        for image, sample_boxes, sample_classes in samples:
+            try:
+                data, sample_boxes, size = _encode(image, np.asarray(sample_boxes, dtype=np.int32).reshape(-1, 4),
+                                                   resize, encoding, quality)
+            except (Exception) as error:
+                errors.append((image, str(error)))
+                continue
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+            lengths.append(len(data))
+            boxes.append(sample_boxes)
+            class_ids.append(np.asarray(sample_classes, dtype=np.int32))
+            box_offsets.append(box_offsets[-1] + len(sample_boxes))
+            sizes.append(size)
+            names.append(os.path.basename(image))
+    os.rename(temp, filename + '.rec')
+
+    temp = filename + '.idx.tmp.npz'
+    np.savez(temp,
+             offsets=np.array(offsets[:-1], dtype=np.int64),
+             lengths=np.array(lengths, dtype=np.int64),
+             box_offsets=np.array(box_offsets, dtype=np.int64),
+             boxes=np.concatenate(boxes) if boxes else np.zeros((0, 4), dtype=np.int32),
+             class_ids=np.concatenate(class_ids) if class_ids else np.zeros(0, dtype=np.int32),
+             sizes=np.array(sizes, dtype=np.int32).reshape(-1, 2),
+             names=np.array(names, dtype=np.str_))
+    os.rename(temp, filename + '.idx.npz')
+    return len(names), errors
+
+def pack(source, out_folder, subset='train', folder='.', samples_per_shard=1000, resize=None, encoding='jpg',
+         quality=95, workers=None, seed=12345, labels=None):
+    """
+        Pack subset of split into sharded record files, shards are written in parallel
+        Args:
+            source: split manifest or split_tt.split_all output folder, see _split_files
+            out_folder: dirname for <subset>-NNNNN-of-NNNNN.rec/.idx.npz shards and <subset>.records.json
+            subset: subset name (train, test, ...)
+            folder: dirname manifest paths are relative to
+            samples_per_shard: int
+            resize: (w, h) - store images resized to net input (None - original encoded files as is)
+            encoding: 'jpg' or 'raw' (decoded pixels, requires resize, read without decoding)
+            quality: int (JPEG quality of resized images)
+            workers: int (number of processes, None - number of cpus)
+            seed: int (samples are shuffled before sharding, None - keep order)
+            labels: list of class names, class id is position in it (None - sorted class names
+                    of all subsets of source, they have to be parsed)
+
+        Returns:
+            info: dict (classes, shards, count, resize, encoding, errors)
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError("Unknown encoding {0}, expected one of {1}".format(encoding, ENCODINGS))
+    if encoding == 'raw' and resize is None:
+        raise ValueError("Raw encoding requires resize")
+
+    annotations, images = _split_files(source, subset, folder)
+    parsed = parsers.parse_bulk(annotations, workers)
+
+    if labels is None:
+        labels = _labels(source, folder, workers)
+    labels = list(labels)
+    unknown = [name for name in parsed['classes'] if name not in labels]
+    if unknown:
+        raise ValueError("Classes {0} are not in labels {1}".format(unknown, labels))
+    mapping = np.array([labels.index(name) for name in parsed['classes']], dtype=np.int32)
+    class_ids = mapping[parsed['class_id']] if len(mapping) > 0 else parsed['class_id']
+
+    boxes = np.stack([parsed[key] for key in ('xmin', 'ymin', 'xmax', 'ymax')], axis=1)
+    starts = np.searchsorted(parsed['file_index'], np.arange(len(annotations) + 1))
+    samples, missing = [], 0
+    for i, image in enumerate(parsed['images']):
+        image = images.get(split_tt._prepend_image_path(image, '', '.jpg')) if image is not None else None
+        if image is None:
+            missing += 1
+            continue
+        samples.append((image, boxes[starts[i]:starts[i + 1]], class_ids[starts[i]:starts[i + 1]]))
+
+    if seed is not None:
+        order = np.random.RandomState(seed).permutation(len(samples))
+        samples = [samples[i] for i in order]
+
+    out_folder = os.path.abspath(out_folder)
+    utils.make_dir(out_folder)
+    shards = max(1, (len(samples) + samples_per_shard - 1) // samples_per_shard)
+    names = [_shard_name(subset, i, shards) for i in range(shards)]
+    tasks = [(os.path.join(out_folder, names[i]), samples[i * samples_per_shard:(i + 1) * samples_per_shard],
+              resize, encoding, quality) for i in range(shards)]
+    results = utils.map_parallel(_pack_shard, tasks, workers)
+
+    errors = [error for _, shard_errors in results for error in shard_errors]
+    info = {'subset' : subset,
+            'classes' : labels,
+            'shards' : names,
+            'count' : sum(count for count, _ in results),
+            'resize' : list(resize) if resize is not None else None,
+            'encoding' : encoding,
+            'errors' : errors}
+    with open(os.path.join(out_folder, subset + RECORDS_SUFFIX), 'w') as f:
+        json.dump(info, f, indent=1)
+
+    print ("Packed {0} samples to {1} shards, {2} without image, {3} errors".format(info['count'], shards, missing,
+                                                                                    len(errors)))
+    return info
+
+
+class RecordReader(object):
+    """
+        Random access to packed samples: shard indices are loaded once, images are read
+        from memory-mapped shards (raw images are returned as views, without copy)
+    """
+
+    def __init__(self, folder, subset='train'):
+        folder = os.path.abspath(folder)
+        with open(os.path.join(folder, subset + RECORDS_SUFFIX), 'r') as f:
+            self.info = json.load(f)
+        self.classes = self.info['classes']
+
+        self.shards, self.indices = [], []
+        for name in self.info['shards']:
+            with np.load(os.path.join(folder, name + '.idx.npz')) as data:
+                self.indices.append(dict((key, data[key]) for key in data.files))
+            self.shards.append(os.path.join(folder, name + '.rec'))
+
+        counts = [len(index['offsets']) for index in self.indices]
+        self.starts = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.data = [None] * len(self.shards)
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def _shard(self, shard):
+        if self.data[shard] is None:
+            if os.path.getsize(self.shards[shard]) == 0:
+                self.data[shard] = np.zeros(0, dtype=np.uint8)
+            else:
+                self.data[shard] = np.memmap(self.shards[shard], dtype=np.uint8, mode='r')
+        return self.data[shard]
+
+    def read(self, i, decode=True):
+        """
+            Returns:
+                dict (image - BGR image or encoded bytes when decode is False, boxes - int32 (N x 4)
+                      xmin, ymin, xmax, ymax, class_ids - int32 (N), size - original (h, w), name)
+        """
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        shard = int(np.searchsorted(self.starts, i, side='right') - 1)
+        j = i - self.starts[shard]
+        index = self.indices[shard]
+
+        offset, length = index['offsets'][j], index['lengths'][j]
+        # Plain ndarray view of memory-mapped shard
+        data = np.asarray(self._shard(shard)[offset:offset + length])
+        if self.info['encoding'] == 'raw':
+            w, h = self.info['resize']
+            image = data.reshape(h, w, 3)
+        elif decode:
+            import cv2
+            image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        else:
+            image = data.tobytes()
+
+        b, e = index['box_offsets'][j], index['box_offsets'][j + 1]
+        return {'image' : image,
+                'boxes' : index['boxes'][b:e],
+                'class_ids' : index['class_ids'][b:e],
+                'size' : tuple(int(v) for v in index['sizes'][j]),
+                'name' : str(index['names'][j])}
+
+    def __getitem__(self, i):
+        return self.read(i)
@@ -0,0 +1,140 @@
+import os
+import xml.etree.cElementTree as etree
+
+import numpy as np
+
+import annotation_index
+import parsers
+import utils
+
+
+def _rewrite(filename, names=None, class_name=None, image_extension='.jpg'):
+    """
+        Fix one annotation: object names and extension of image filename
+        File is written (to temp file and renamed) only when something changed
+        Returns:
+            (changed, image_filename, object names, bboxes) - values after fix
+    """
+    tree = etree.ElementTree(file=filename)
+    root = tree.getroot()
+    changed = False
+
+    element = root.find('filename')
+    if element is None or element.text is None:
+        raise ValueError("filename not found")
+    if image_extension and not element.text.endswith(image_extension):
+        element.text = element.text + image_extension
+        changed = True
+
+    object_names, bboxes = [], []
+    for obj in root.iter('object'):
+        name = obj.find('name')
+        old = name.text if name is not None else ''
+        new = class_name if class_name else (names or {}).get(old, old)
+        if new != old:
+            if name is None:
+                name = etree.SubElement(obj, 'name')
+            name.text = new
+            changed = True
+        xmlbox = obj.find('bndbox')
+        bboxes.append([int(float(xmlbox.find(tag).text)) for tag in ('xmin', 'ymin', 'xmax', 'ymax')])
+        object_names.append(new)
+
+    if changed:
+        temp = filename + '.tmp'
+        tree.write(temp)
+        os.rename(temp, filename)
+    return changed, element.text, object_names, bboxes
+
+def _rewrite_files(task):
+    """
+        Rewrite chunk of files, result has the same layout as parsers._parse_files
+    """
+    files, names, class_name, image_extension = task
+    images, errors, classes = [], [], {}
+    file_index, class_ids, bboxes = [], [], []
+    changed = 0
+    for i, fl in enumerate(files):
+        try:
+            file_changed, image_filename, object_names, boxes = _rewrite(fl, names, class_name, image_extension)
+        except (Exception) as error:
+            images.append(None)
+            errors.append((fl, str(error)))
+            continue
+
+        changed += int(file_changed)
+        images.append(image_filename)
+        for name, box in zip(object_names, boxes):
+            file_index.append(i)
+            class_ids.append(classes.setdefault(name, len(classes)))
+            bboxes.append(box)
+
+    object_names = sorted(classes, key=classes.get)
+    return changed, (images, errors, object_names, file_index, class_ids, bboxes)
+
+def relabel(source, names=None, class_name=None, image_extension='.jpg', workers=None, chunk_size=1000,
+            update_index=False):
+    """
+        Bulk in-place rewrite of Pascal VOC annotations on a process pool
+        Args:
+            source: dirname with *.xml files or list of *.xml files
+            names: dict old object name -> new object name (optional)
+            class_name: set name of every object (optional, overrides names)
+            image_extension: string appended to image filename that has no such extension (None - keep filenames)
+            workers: int (number of processes, None - number of cpus)
+            chunk_size: int (number of files rewritten by one task)
+            update_index: bool (put result to annotation index of each folder, so nothing is parsed again)
+
+        Returns:
+            dict (changed - number of rewritten files, total, errors, parsed - see parsers.parse_bulk)
+    """
+    if isinstance(source, (list, tuple)):
+        files = list(source)
+    else:
+        files = parsers.list_files(source, '.xml')
+
+    chunks = [files[i:i + chunk_size] for i in range(0, len(files), chunk_size)]
+    tasks = [(chunk, names, class_name, image_extension) for chunk in chunks]
+    results = utils.map_parallel(_rewrite_files, tasks, workers)
+
+    changed = sum(result[0] for result in results)
+    parsed = parsers._merge_parts(files, [result[1] for result in results], chunk_size)
+
+    if update_index:
+        folders = {}
+        for i, fl in enumerate(files):
+            folders.setdefault(os.path.dirname(os.path.abspath(fl)), []).append(i)
+        for folder, indices in folders.items():
+            annotation_index.update(folder, _take(parsed, indices))
+
+    print ("Changed {0} of {1} annotations".format(changed, len(files)))
+    return {'changed' : changed, 'total' : len(files), 'errors' : parsed['errors'], 'parsed' : parsed}
+
+def set_object_name(files, class_name):
+    """
+        Set name of every object (class_name '' - keep names) and add .jpg to image filenames
+    """
+    if len(files) <= 0:
+        print ("Files can't be empty")
+        return
+
+    return relabel(files, class_name=class_name or None)['changed']
+
+def _take(parsed, indices):
+    """
+        Files (by sorted indices) of parse_bulk result with their boxes
+    """
+    keep = np.zeros(len(parsed['files']), dtype=bool)
+    keep[indices] = True
+    box_mask = keep[parsed['file_index']]
+    files = [parsed['files'][i] for i in indices]
+    selected = set(files)
+
+    part = {'files' : files,
+            'images' : [parsed['images'][i] for i in indices],
+            'classes' : parsed['classes'],
+            'errors' : [error for error in parsed['errors'] if error[0] in selected]}
+    part['file_index'] = (np.cumsum(keep) - 1)[parsed['file_index'][box_mask]].astype(np.int32)
+    for key in ('class_id', 'xmin', 'ymin', 'xmax', 'ymax'):
+        part[key] = parsed[key][box_mask]
+    return part
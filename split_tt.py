@@ -2,7 +2,14 @@ import sys
 import os
 import utils
 import parsers
+import annotation_index
 import shutil
+import errno
+import zlib
+import struct
+import hashlib
+
+import numpy as np
 
 def split(data):
     n = len(data)
@@ -11,19 +18,70 @@ def split(data):
     print ("Images splitted to train({0}), test({1})".format(tn_e, (ts_e - ts_s)))
     return data[tn_s:tn_e], data[ts_s:ts_e]
 
-def split_all(labels, folder='.', out_folder='.'):
+SAVE_MODES = ('copy', 'hardlink', 'symlink', 'manifest')
+
+def split_all(labels, folder='.', out_folder='.', use_index=False, mode='copy'):
+    """
+        Split annotations and images of each label to train/test
+        Args:
+            labels: list of class names
+            folder: dirname with annotations/<label> and images/<label>
+            out_folder: dirname where train/ and test/ are created
+            use_index: bool (take image names from annotation index, see annotation_index)
+            mode: how files are saved, see _save
+    """
     if len(labels) <= 0:
         print ("Labels count can't be 0")
         return
+
+    if mode == 'manifest':
+        # Lists are appended by each label
+        for ops in ('train', 'test'):
+            for postfix in ('images', 'annotations'):
+                utils.rmfile(_manifest_filename(os.path.abspath(out_folder), ops, postfix))
     
     for lbl in labels:
-          _split_data(lbl, folder, out_folder)
+          _split_data(lbl, folder, out_folder, use_index, mode)
+
+def _manifest_filename(folder, ops, postfix):
+    return os.path.join(folder, '{0}/{1}.txt'.format(ops, postfix))
+
+def _unlink(target):
+    # lexists: symlink is removed even when file it points to was deleted
+    if os.path.lexists(target):
+        os.remove(target)
 
-def _save(files, folder='.', train=True, image=True):
+def _link(fl, target_dir, mode='copy'):
+    target = os.path.join(target_dir, os.path.basename(fl))
+    if mode == 'copy':
+        shutil.copy(fl, target_dir)
+        return
+
+    _unlink(target)
+    if mode == 'symlink':
+        os.symlink(os.path.abspath(fl), target)
+        return
+
+    try:
+        os.link(fl, target)
+    except OSError as e:
+        # Hardlinks are not possible across file systems
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy(fl, target_dir)
+
+def _save(files, folder='.', train=True, image=True, mode='copy'):
     """
         Save files to folders: 
             train/test  / images/annotations
+        Args:
+            mode: 'copy' - copy files,
+                  'hardlink' - hard links (no extra space, copy if folders are on different file systems),
+                  'symlink' - symbolic links to original files,
+                  'manifest' - append paths of original files to train/test / images/annotations.txt
     """
+    if mode not in SAVE_MODES:
+        raise ValueError("Unknown save mode {0}, expected one of {1}".format(mode, SAVE_MODES))
     folder = os.path.abspath(folder)
     
     postfix = "images" if image else "annotations"
@@ -31,15 +89,24 @@ def _save(files, folder='.', train=True, image=True):
     
     target_dir = os.path.join(folder, '{0}/{1}'.format(ops, postfix))
     
-    utils.make_dir(target_dir)
+    utils.make_dir(target_dir if mode != 'manifest' else os.path.join(folder, ops))
     
-    cnt = 0
+    cnt, saved = 0, []
     for fl in files:
         if os.path.exists(fl):
-            shutil.copy(fl, target_dir)
+            if mode == 'manifest':
+                saved.append(os.path.abspath(fl))
+            else:
+                _link(fl, target_dir, mode)
             cnt += 1
         else:
             print ("Not exists {0}".format(fl))
+
+    if mode == 'manifest':
+        target_dir = _manifest_filename(folder, ops, postfix)
+        with open(target_dir, 'a') as f:
+            for fl in saved:
+                f.write(fl + '\n')
     
     print ("Saved {0} files to {1}".format(cnt, target_dir))
     return target_dir
@@ -51,41 +118,16 @@ def _remove_without_image(files, folder='.'):
         print ("Image folder not exists")
         return []
     
-    images = parsers.list_files(folder, '.jpg')
+    images = parsers.index_files(folder, '.jpg')
     if len(images) <= 0:
         print ("Images folder is empty")
         return []
         
-    filtered = []
-    for fl in files:
-        filename = utils.get_filename(fl)
-        image_file = os.path.join(folder, filename + '.jpg' )
-        
-        if os.path.exists(image_file):
-            filtered.append(fl)
-    return filtered   
-
-def _fetch_images_from_annotations(annotations):    
-    annotations = os.path.abspath(annotations)
-    if not os.path.exists(annotations):       
-        print ("Annotations folder not exists")
-        return    
-
-    files = parsers.list_files(annotations, '.xml')
-    
-    images = []
-    for fl in files:
-        res = parsers.parse_from_pascal_voc_format(fl)
-        if res is not None and len(res) > 0:
-            images.append(res[0])
-        else:
-            print ("Error parsing {0}".format(fl))
-    
-    return images   
+    return [fl for fl in files if utils.get_filename(fl) in images]
 
 def _prepend_image_path(filename, folder='', extension=''): 
     
-    if extension != '':
+    if extension != '' and not filename.endswith(extension):
         filename = filename + extension 
         
     if folder != '':
@@ -99,7 +141,31 @@ def _prepend_images_path(filenames, folder='', extension=''):
         result.append(_prepend_image_path(fl, folder, extension))
     return result
 
-def _split_data(class_name, folder='.', out_folder='.'):
+def _image_names(files, annotations_folder, use_index=False):
+    """
+        Image filename of each annotation, parsed once from original annotations
+        Returns:
+            dict annotation basename -> image filename
+    """
+    if use_index:
+        index = annotation_index.load(annotations_folder)
+        return dict(zip(index['files'], index['images']))
+
+    parsed = parsers.parse_bulk(files)
+    return dict((os.path.basename(fl), image) for fl, image in zip(parsed['files'], parsed['images']) 
+                if image is not None)
+
+def _images_for(files, image_names):
+    images = []
+    for fl in files:
+        image = image_names.get(os.path.basename(fl))
+        if image is not None:
+            images.append(image)
+        else:
+            print ("Error parsing {0}".format(fl))
+    return images
+
+def _split_data(class_name, folder='.', out_folder='.', use_index=False, mode='copy'):
     
     print ('Processing {0}...'.format(class_name))
     
@@ -114,21 +180,338 @@ def _split_data(class_name, folder='.', out_folder='.'):
     if len(files) <= 0:
         print ('Annotations not correspond images for {0}'.format(class_name))
         return
+
+    # Image names come from one pass over original annotations, saved ones are never parsed again
+    image_names = _image_names(files, os.path.join(annotations, class_name), use_index)
     
     data = utils.randomize(files)
     train, test = split(data)
     
     out_folder = os.path.abspath(out_folder)
    
-    ann_train_dir = _save(train, out_folder, image=False)
-    ann_test_dir  = _save(test , out_folder, train=False, image=False)
-    
-    images = _fetch_images_from_annotations(ann_train_dir)
-    images = _prepend_images_path(images, images_folder, '.jpg')    
-    _save(images, out_folder)
+    _save(train, out_folder, image=False, mode=mode)
+    _save(test , out_folder, train=False, image=False, mode=mode)
+
+    images = _prepend_images_path(_images_for(train, image_names), images_folder, '.jpg')    
+    _save(images, out_folder, mode=mode)
     
-    images = _fetch_images_from_annotations(ann_test_dir)
-    images = _prepend_images_path(images, images_folder, '.jpg')    
-    _save(images, out_folder, train=False)
-   
-    
\ No newline at end of file
+    images = _prepend_images_path(_images_for(test, image_names), images_folder, '.jpg')    
+    _save(images, out_folder, train=False, mode=mode)
+
+# Stratified split
+SPLIT_MANIFEST = 'split.tsv'
+DEFAULT_RATIOS = (('train', .8), ('test', .2))
+COUNT_EDGES = (2, 4)
+GOLDEN = (5 ** .5 - 1) / 2
+
+def _draw_seed():
+    # From os entropy, so global random state is not touched
+    return struct.unpack('<I', os.urandom(4))[0]
+
+def split_stratified(labels, folder='.', ratios=DEFAULT_RATIOS, folds=0, seed=12345, size_buckets=3,
+                     workers=None, out_file=None):
+    """
+        Split annotations of all labels to any number of subsets (e.g. train/val/test) at once.
+        Each class is stratified by number of boxes (1, 2-3, 4+) and mean box size (size_buckets
+        quantiles within class), so every subset gets the same mix of easy and hard images.
+        Files are not copied, the result is a manifest (see save_manifest, materialize)
+        Args:
+            labels: list of class names
+            folder: dirname with annotations/<label> and images/<label>
+            ratios: list of tuples (subset name, ratio), ratios are normalized
+            folds: int (number of stratified cross validation folds, 0 - no folds)
+            seed: int (the same seed gives the same split, global random state is not touched,
+                  None - random seed, it is recorded in manifest to reproduce the split)
+            size_buckets: int (number of box size buckets)
+            workers: int (number of processes, classes are split in parallel, None - number of cpus)
+            out_file: manifest filename (None - <folder>/split.tsv)
+
+        Returns:
+            manifest: dict (ratios, folds, seed, rows - list of tuples (subset, fold, label, annotation, image),
+                      paths are relative to folder, fold is -1 without folds)
+    """
+    folder = os.path.abspath(folder)
+    ratios = [(name, float(ratio)) for name, ratio in ratios]
+    if len(ratios) <= 0 or min(ratio for _, ratio in ratios) < 0 or sum(ratio for _, ratio in ratios) <= 0:
+        raise ValueError("Ratios must be non negative with positive sum : {0}".format(ratios))
+    if seed is None:
+        seed = _draw_seed()
+
+    tasks = [(lbl, folder, ratios, folds, seed, size_buckets) for lbl in labels]
+    rows = []
+    for part in utils.map_parallel(_split_class, tasks, workers):
+        rows.extend(part)
+
+    manifest = {'ratios' : ratios, 'folds' : folds, 'seed' : seed, 'rows' : rows}
+    save_manifest(manifest, out_file if out_file is not None else os.path.join(folder, SPLIT_MANIFEST))
+
+    counts = dict((name, 0) for name, _ in ratios)
+    for row in rows:
+        counts[row[0]] += 1
+    print ("Images splitted to {0}".format(", ".join("{0}({1})".format(name, counts[name]) for name, _ in ratios)))
+    return manifest
+
+def _class_samples(class_name, folder):
+    """
+        Annotations of class that have image, with number of boxes and mean box size of each
+        Returns:
+            (annotations, images, counts, sizes) - lists of relative paths and arrays
+    """
+    index = annotation_index.load(os.path.join(folder, 'annotations', class_name), workers=1)
+    if index is None or len(index['files']) <= 0:
+        return [], [], np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    images_folder = os.path.join(folder, 'images', class_name)
+    existing = parsers.index_files(images_folder, '.jpg') if os.path.exists(images_folder) else {}
+
+    n = len(index['files'])
+    counts = np.bincount(index['file_index'], minlength=n)
+    areas = np.bincount(index['file_index'], annotation_index.bounding_boxes(index).prod(axis=1).astype(np.float64),
+                        minlength=n)
+    sizes = np.sqrt(areas / np.maximum(counts, 1))
+
+    keep = [i for i, image in enumerate(index['images']) if utils.get_filename(image) in existing]
+    annotations = [os.path.join('annotations', class_name, index['files'][i]) for i in keep]
+    images = [os.path.join('images', class_name, _prepend_image_path(utils.get_filename(index['images'][i]), '', '.jpg'))
+              for i in keep]
+    return annotations, images, counts[keep], sizes[keep]
+
+def _strata(counts, sizes, size_buckets=3):
+    count_bucket = np.digitize(counts, COUNT_EDGES)
+    if len(sizes) > 0 and size_buckets > 1:
+        edges = np.quantile(sizes, np.arange(1, size_buckets) / float(size_buckets))
+        size_bucket = np.digitize(sizes, edges)
+    else:
+        size_bucket = np.zeros(len(sizes), dtype=np.int64)
+    return count_bucket * size_buckets + size_bucket
+
+def _assign(strata, ratios, folds, rng):
+    """
+        Stratified assignment: samples of each stratum are shuffled and laid out one stratum after
+        another, then subsets are assigned along this order with golden ratio sequence (low discrepancy),
+        so each stratum and the whole class get subsets in proportion to ratios, folds - round robin
+        Returns:
+            (subset index, fold) - int arrays
+    """
+    n = len(strata)
+    order = np.concatenate([rng.permutation(np.nonzero(strata == s)[0]) for s in np.unique(strata)] or
+                           [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+
+    weights = np.array([ratio for _, ratio in ratios], dtype=np.float64)
+    bounds = np.cumsum(weights / weights.sum())[:-1]
+    u = (rng.rand() + np.arange(n) * GOLDEN) % 1.
+
+    subset, fold = np.zeros(n, dtype=np.int64), np.full(n, -1, dtype=np.int64)
+    subset[order] = np.searchsorted(bounds, u, side='right')
+    if folds > 0:
+        fold[order] = (rng.randint(folds) + np.arange(n)) % folds
+    return subset, fold
+
+def _split_class(task):
+    class_name, folder, ratios, folds, seed, size_buckets = task
+    annotations, images, counts, sizes = _class_samples(class_name, folder)
+    if len(annotations) <= 0:
+        print ('Annotations not correspond images for {0}'.format(class_name))
+        return []
+
+    # Local generator seeded by class name: result doesn't depend on order or process of classes
+    rng = np.random.RandomState([seed & 0xffffffff, zlib.crc32(class_name.encode('utf-8')) & 0xffffffff])
+    subset, fold = _assign(_strata(counts, sizes, size_buckets), ratios, folds, rng)
+    return [(ratios[s][0], int(f), class_name, annotation, image)
+            for s, f, annotation, image in zip(subset, fold, annotations, images)]
+
+def save_manifest(manifest, filename):
+    """
+        Save split manifest: header line with parameters and one tab separated line per sample
+        (subset, fold, label, annotation, image). Written atomically
+    """
+    temp = filename + '.tmp'
+    with open(temp, 'w') as f:
+        f.write('# ratios {0} folds {1} seed {2}\n'.format(
+                ','.join('{0}:{1}'.format(name, ratio) for name, ratio in manifest['ratios']),
+                manifest['folds'], manifest['seed']))
+        for row in manifest['rows']:
+            f.write('\t'.join(str(value) for value in row) + '\n')
+    os.rename(temp, filename)
+    print ("Saved split of {0} files to {1}".format(len(manifest['rows']), filename))
+    return filename
+
+def read_manifest(filename):
+    """
+        Read manifest saved by save_manifest
+    """
+    manifest = {'ratios' : [], 'folds' : 0, 'seed' : None, 'rows' : []}
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('#'):
+                params = line[1:].split()
+                values = dict(zip(params[0::2], params[1::2]))
+                manifest['ratios'] = [(item.rsplit(':', 1)[0], float(item.rsplit(':', 1)[1]))
+                                      for item in values['ratios'].split(',')]
+                manifest['folds'] = int(values['folds'])
+                manifest['seed'] = int(values['seed']) if values['seed'] != 'None' else None
+            elif line:
+                subset, fold, label, annotation, image = line.split('\t')
+                manifest['rows'].append((subset, int(fold), label, annotation, image))
+    return manifest
+
+def select(manifest, subset=None, folds=None, folder='.'):
+    """
+        Files of subset and/or folds
+        Args:
+            manifest: dict or manifest filename
+            subset: subset name (None - any)
+            folds: list of folds (None - any), e.g. all folds except k for training of k-th fold
+            folder: dirname manifest paths are relative to
+
+        Returns:
+            (annotations, images) - lists of absolute paths
+    """
+    if not isinstance(manifest, dict):
+        manifest = read_manifest(manifest)
+    folder = os.path.abspath(folder)
+    folds = set(folds) if folds is not None else None
+
+    annotations, images = [], []
+    for name, fold, _, annotation, image in manifest['rows']:
+        if (subset is None or name == subset) and (folds is None or fold in folds):
+            annotations.append(os.path.join(folder, annotation))
+            images.append(os.path.join(folder, image))
+    return annotations, images
+
+def _stale(fl, target_dir, mode):
+    """
+        Whether materialized copy/link of fl in target_dir doesn't show current content of fl
+    """
+    target = os.path.join(target_dir, os.path.basename(fl))
+    if not os.path.lexists(target):
+        return True
+    if mode == 'symlink' or not os.path.exists(fl):
+        return False
+    source_stat, target_stat = os.stat(fl), os.stat(target)
+    if mode == 'hardlink' and source_stat.st_dev == target_stat.st_dev:
+        # Atomic rewrite (temp file + rename) gives source a new inode
+        return source_stat.st_ino != target_stat.st_ino
+    return source_stat.st_size != target_stat.st_size or source_stat.st_mtime > target_stat.st_mtime
+
+def materialize(manifest, folder='.', out_folder='.', mode='hardlink', previous=None):
+    """
+        Create <subset>/images and <subset>/annotations folders from manifest
+        (for tools that need files, not lists)
+        Args:
+            mode: 'copy', 'hardlink' or 'symlink', see _link
+            previous: manifest already materialized in out_folder (optional, default - copy of manifest
+                      saved to out_folder by last materialize), only files that moved are linked or removed
+    """
+    if mode not in SAVE_MODES or mode == 'manifest':
+        raise ValueError("Unknown save mode {0}".format(mode))
+    if not isinstance(manifest, dict):
+        manifest = read_manifest(manifest)
+    out_folder = os.path.abspath(out_folder)
+    record = os.path.join(out_folder, SPLIT_MANIFEST)
+    if previous is None and os.path.exists(record):
+        previous = record
+    if previous is not None and not isinstance(previous, dict):
+        previous = read_manifest(previous)
+    subsets = [name for name, _ in manifest['ratios']]
+    if previous is not None:
+        subsets += [name for name, _ in previous['ratios'] if name not in subsets]
+
+    for name in subsets:
+        annotations, images = select(manifest, name, folder=folder)
+        old_annotations, old_images = select(previous, name, folder=folder) if previous is not None else ([], [])
+        for postfix, files, old_files in (('annotations', annotations, old_annotations),
+                                          ('images', images, old_images)):
+            target_dir = os.path.join(out_folder, name, postfix)
+            utils.make_dir(target_dir)
+            current, old = set(files), set(old_files)
+            # Folders are flat, keep targets still used by other files with the same basename
+            basenames = set(os.path.basename(fl) for fl in current)
+            removed = [fl for fl in old - current if os.path.basename(fl) not in basenames]
+            for fl in removed:
+                _unlink(os.path.join(target_dir, os.path.basename(fl)))
+            # Files that stayed are relinked when their content changed (e.g. rewritten by relabel)
+            added = [fl for fl in files if fl not in old or _stale(fl, target_dir, mode)]
+            for fl in added:
+                _link(fl, target_dir, mode)
+            print ("Saved {0} files to {1}, removed {2}".format(len(added), target_dir, len(removed)))
+
+    # Record of materialized files for the next update
+    save_manifest(manifest, record)
+
+# Incremental split
+def _hash_unit(key, seed=12345):
+    """
+        Stable (across runs, processes and python versions) pseudo random number in [0, 1) for key
+    """
+    digest = hashlib.md5('{0}:{1}'.format(seed, key).encode('utf-8')).digest()
+    return struct.unpack('>Q', digest[:8])[0] / float(2 ** 64)
+
+def _hash_assign(key, ratios, folds, seed=12345):
+    """
+        Subset and fold of file by hash of its name: the assignment depends only on the file,
+        not on other files of dataset
+    """
+    weights = np.array([ratio for _, ratio in ratios], dtype=np.float64)
+    bounds = np.cumsum(weights / weights.sum())[:-1]
+    subset = ratios[int(np.searchsorted(bounds, _hash_unit(key, seed), side='right'))][0]
+    fold = int(_hash_unit(key, seed + 1) * folds) if folds > 0 else -1
+    return subset, fold
+
+def _list_class(task):
+    class_name, folder = task
+    annotations, images, _, _ = _class_samples(class_name, folder)
+    return [(class_name, annotation, image) for annotation, image in zip(annotations, images)]
+
+def split_incremental(labels, folder='.', ratios=DEFAULT_RATIOS, folds=0, seed=12345, workers=None,
+                      out_file=None, out_folder=None, mode='hardlink'):
+    """
+        Update split manifest after dataset changed: files of existing manifest keep their subset and fold,
+        deleted files are dropped, new files are assigned by hash of their path (see _hash_assign).
+        The assignment of each file is deterministic, so test set membership is stable across dataset versions.
+        Annotations are parsed only when new or changed (see annotation_index)
+        Args:
+            labels, folder, ratios, folds, workers, out_file: see split_stratified
+            seed: int (None - seed of existing manifest, or random one for the new manifest)
+            out_folder: dirname with materialized subsets to update (None - only manifest)
+            mode: see materialize
+
+        Returns:
+            manifest: see split_stratified, with 'added' and 'removed' counts
+    """
+    folder = os.path.abspath(folder)
+    ratios = [(name, float(ratio)) for name, ratio in ratios]
+    out_file = out_file if out_file is not None else os.path.join(folder, SPLIT_MANIFEST)
+
+    previous = read_manifest(out_file) if os.path.exists(out_file) else None
+    if seed is None:
+        seed = previous['seed'] if previous is not None and previous['seed'] is not None else _draw_seed()
+    kept = {}
+    if previous is not None:
+        if previous['ratios'] == ratios and previous['folds'] == folds:
+            kept = dict((row[3], row) for row in previous['rows'])
+        else:
+            print ("Ratios or folds changed, all files are assigned by hash")
+
+    rows, added = [], 0
+    for part in utils.map_parallel(_list_class, [(lbl, folder) for lbl in labels], workers):
+        for class_name, annotation, image in part:
+            row = kept.get(annotation)
+            if row is None or row[2] != class_name or row[4] != image:
+                subset, fold = _hash_assign(annotation, ratios, folds, seed)
+                row = (subset, fold, class_name, annotation, image)
+                added += 1
+            rows.append(row)
+
+    current = set(row[3] for row in rows)
+    removed = len([annotation for annotation in kept if annotation not in current])
+
+    manifest = {'ratios' : ratios, 'folds' : folds, 'seed' : seed, 'rows' : rows}
+    save_manifest(manifest, out_file)
+    if out_folder is not None:
+        materialize(manifest, folder, out_folder, mode)
+
+    print ("Split updated : {0} added, {1} removed, {2} unchanged".format(added, removed, len(rows) - added))
+    manifest['added'], manifest['removed'] = added, removed
+    return manifest
@@ -0,0 +1,211 @@
+import numpy as np
+
+
+def _iou_matrix(a, b):
+    """
+        IOU between each pair of boxes
+        Args:
+            a: array (N x 4) of corners left, top, right, bottom
+            b: array (M x 4) of corners left, top, right, bottom
+
+        Returns:
+            array (N x M)
+    """
+    a, b = a[:, np.newaxis, :], b[np.newaxis, :, :]
+    iw = np.maximum(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0)
+    ih = np.maximum(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0)
+    intersection = iw * ih
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    union = area_a + area_b - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-12), 0.)
+
+def _to_corners(boxes):
+    # YoloNet format [[class_indx, class_name, confidence], [left, right, top, bot]]
+    corners = [[b[1][0], b[1][2], b[1][1], b[1][3]] for b in boxes]
+    return np.array(corners, dtype=np.float64).reshape(-1, 4)
+
+
+class BoxTracker(object):
+    """
+        Keeps detections alive between keyframes: detections are associated with tracks by IOU,
+        on other frames each track is moved with its (smoothed) constant velocity
+    """
+
+    def __init__(self, iou_threshold=0.3, max_misses=2, smoothing=0.5):
+        """
+            Args:
+                iou_threshold: float (min IOU between predicted track and detection to match them)
+                max_misses: int (number of keyframes a track survives without matched detection)
+                smoothing: float [0, 1] (gain of velocity correction from prediction error)
+        """
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.smoothing = smoothing
+
+        self.corners   = np.zeros((0, 4), dtype=np.float64)
+        self.velocity  = np.zeros((0, 4), dtype=np.float64)
+        self.misses    = np.zeros(0, dtype=np.int32)
+        self.hits      = np.zeros(0, dtype=np.int32)
+        self.error     = np.zeros(0, dtype=np.float64)
+        self.infos     = []
+        self.frames_since_update = 0
+        self.image_shape = None
+
+    def update(self, boxes, image_shape):
+        """
+            Correct tracks with detections of keyframe
+            Args:
+                boxes: detections in YoloNet.detect format
+                image_shape: (h, w) of frame
+            Returns:
+                boxes: tracked boxes in YoloNet.detect format
+        """
+        self.image_shape = image_shape[:2]
+        detections = _to_corners(boxes)
+        infos = [list(b[0]) for b in boxes]
+
+        # Predict tracks to the current frame before matching
+        self.corners = self.corners + self.velocity
+        frames = self.frames_since_update + 1
+
+        matched_tracks, matched_detections = self._associate(detections, infos)
+
+        # Matched tracks: velocity correction from prediction error
+        corners, velocity, error = self.corners.copy(), self.velocity.copy(), self.error.copy()
+        if len(matched_tracks) > 0:
+            residual = (detections[matched_detections] - self.corners[matched_tracks]) / frames
+            velocity[matched_tracks] += self.smoothing * residual
+            error[matched_tracks] = np.abs(residual).max(axis=1)
+            corners[matched_tracks] = detections[matched_detections]
+
+        misses, hits = self.misses + 1, self.hits.copy()
+        misses[matched_tracks] = 0
+        hits[matched_tracks] += 1
+        for t, d in zip(matched_tracks, matched_detections):
+            self.infos[t] = infos[d]
+
+        alive = misses <= self.max_misses
+        new = np.setdiff1d(np.arange(len(infos)), matched_detections)
+
+        self.corners  = np.concatenate([corners[alive], detections[new]])
+        self.velocity = np.concatenate([velocity[alive], np.zeros((len(new), 4))])
+        self.misses   = np.concatenate([misses[alive], np.zeros(len(new), dtype=np.int32)])
+        self.hits     = np.concatenate([hits[alive], np.ones(len(new), dtype=np.int32)])
+        self.error    = np.concatenate([error[alive], np.zeros(len(new))])
+        self.infos    = [info for info, a in zip(self.infos, alive) if a] + [infos[d] for d in new]
+        self.frames_since_update = 0
+        return self.boxes()
+
+    def predict(self):
+        """
+            Move tracks one frame forward
+            Returns:
+                boxes: tracked boxes in YoloNet.detect format
+        """
+        self.corners = self.corners + self.velocity
+        self.frames_since_update += 1
+        return self.boxes()
+
+    def motion(self):
+        """
+            Mean motion of tracks not explained by constant velocity model
+            (prediction error at last keyframe, pixels per frame) relative to their size
+            Returns:
+                float or None if velocity of tracks is unknown yet (every track seen only once)
+        """
+        known = self.hits > 1
+        if not np.any(known):
+            return None
+        corners = self.corners[known]
+        size = np.maximum(np.hypot(corners[:, 2] - corners[:, 0], corners[:, 3] - corners[:, 1]), 1.)
+        return float(np.mean(self.error[known] / size))
+
+    def boxes(self):
+        if self.corners.shape[0] == 0:
+            return []
+        h, w = self.image_shape
+        corners = self.corners.copy()
+        corners[:, [0, 2]] = np.clip(corners[:, [0, 2]], 0, w - 1)
+        corners[:, [1, 3]] = np.clip(corners[:, [1, 3]], 0, h - 1)
+        corners = corners.astype(np.int64)
+
+        boxes = []
+        for (left, top, right, bot), info, misses in zip(corners, self.infos, self.misses):
+            if misses > 0 or right <= left or bot <= top:
+                continue
+            boxes.append([list(info), [int(left), int(right), int(top), int(bot)]])
+        return boxes
+
+    def _associate(self, detections, infos):
+        """
+            Greedy matching by IOU, only boxes of the same class are matched
+        """
+        if self.corners.shape[0] == 0 or detections.shape[0] == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        ious = _iou_matrix(self.corners, detections)
+        track_classes = np.array([info[0] for info in self.infos])
+        detection_classes = np.array([info[0] for info in infos])
+        ious[track_classes[:, np.newaxis] != detection_classes[np.newaxis, :]] = 0
+
+        matched_tracks, matched_detections = [], []
+        for index in np.argsort(-ious, axis=None, kind='stable'):
+            t, d = np.unravel_index(index, ious.shape)
+            if ious[t, d] < self.iou_threshold:
+                break
+            if t in matched_tracks or d in matched_detections:
+                continue
+            matched_tracks.append(t)
+            matched_detections.append(d)
+        return np.array(matched_tracks, dtype=np.int64), np.array(matched_detections, dtype=np.int64)
+
+
+class TrackingDetector(object):
+    """
+        Runs net only on keyframes and tracks boxes in between. Keyframe interval adapts to motion:
+        fast objects - detect more often, static scene - less often.
+        Has the same detect/draw_detections interface as YoloNet, so it can replace it
+        (e.g. in video_detector.VideoDetector)
+    """
+
+    def __init__(self, net, tracker=None, interval=3, min_interval=1, max_interval=10, max_displacement=0.1):
+        """
+            Args:
+                net: YoloNet
+                tracker: BoxTracker (optional)
+                interval: int (keyframe interval when there is nothing to track)
+                min_interval, max_interval: int (limits of keyframe interval)
+                max_displacement: float (allowed motion between keyframes relative to box size)
+        """
+        self.net = net
+        self.tracker = tracker if tracker is not None else BoxTracker()
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_displacement = max_displacement
+
+        self.count, self.keyframe = 0, 0
+        self.detections = 0
+
+    def detect(self, image):
+        if self.count >= self.keyframe:
+            boxes = self.tracker.update(self.net.detect(image), image.shape)
+            self.detections += 1
+            self.count, self.keyframe = 0, self._next_interval()
+        else:
+            boxes = self.tracker.predict()
+        self.count += 1
+        return boxes
+
+    def draw_detections(self, image, boxes):
+        return self.net.draw_detections(image, boxes)
+
+    def _next_interval(self):
+        motion = self.tracker.motion()
+        if motion is None:
+            return self.interval
+        if motion <= 0:
+            return self.max_interval
+        interval = int(self.max_displacement / motion)
+        return max(self.min_interval, min(self.max_interval, interval))
@@ -3,6 +3,8 @@ import shutil
 import tarfile
 import sys
 import random
+import errno
+import multiprocessing
 
 if sys.version_info >= (3,):
     import urllib.request as urllib2
@@ -25,6 +27,24 @@ def randomize(data):
     data = [data[i] for i in shuffled_index]
     return data
 
+def map_parallel(func, tasks, workers=1):
+    """
+        Apply func to each task on a process pool, keeps order of tasks
+        Args:
+            func: picklable (module level) function
+            tasks: list of arguments
+            workers: int (number of processes, None - number of cpus, 1 - run in current process)
+    """
+    if (workers is not None and workers <= 1) or len(tasks) <= 1:
+        return [func(task) for task in tasks]
+
+    pool = multiprocessing.Pool(processes=workers)
+    try:
+        return pool.map(func, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
 def rmfile(filename):
     if os.path.exists(filename):
         os.remove(filename)
@@ -37,19 +57,58 @@ def rmdir(directory):
 
 def make_dir(directory):
     if not os.path.exists(directory):
-        os.makedirs(directory)
-        print ("Created directory {0}".format(directory))
+        try:
+            os.makedirs(directory)
+            print ("Created directory {0}".format(directory))
+        except OSError as e:
+            # Created by another thread/process meanwhile
+            if e.errno != errno.EEXIST:
+                raise
     return directory
 
-def extract_tar_file(filename):
-    tar = tarfile.open(filename)
-    tar.extractall()
-    tar.close()
+def iter_tar_stream(fileobj, prefix=''):
+    """
+        Read regular files from tar(.gz) stream (e.g. http response) without seeking or temp files
+        Args:
+            fileobj: readable file-like object
+            prefix: string (only members with name that starts with prefix are read)
+
+        Yields:
+            (basename, bytes) for each member
+    """
+    tar = tarfile.open(fileobj=fileobj, mode='r|*')
+    try:
+        for member in tar:
+            if not member.isfile() or not member.name.startswith(prefix):
+                continue
+            f = tar.extractfile(member)
+            yield os.path.basename(member.name), f.read()
+    finally:
+        tar.close()
+
+def extract_tar_stream(fileobj, folder, prefix=''):
+    """
+        Extract regular files from tar(.gz) stream directly into folder (flat, by basename)
+        Each file is written to temporary file and renamed
+        Returns:
+            count: int (number of extracted files)
+    """
+    make_dir(folder)
+    count = 0
+    for name, data in iter_tar_stream(fileobj, prefix):
+        filename = os.path.join(folder, name)
+        with open(filename + '.part', 'wb') as f:
+            f.write(data)
+        os.rename(filename + '.part', filename)
+        count += 1
+    return count
 
 def download_file(url, filename, min_size=0):
     u = urllib2.urlopen(url)       
     
-    with open(filename, 'wb') as f:
+    # Write to temporary file and rename when complete, so interrupted transfer never leaves truncated file
+    temp = filename + '.part'
+    with open(temp, 'wb') as f:
         meta = u.info()
         meta_func = meta.getheaders if hasattr(meta, 'getheaders') else meta.get_all
         meta_length = meta_func("Content-Length")
@@ -57,10 +116,10 @@ def download_file(url, filename, min_size=0):
         if meta_length:
             file_size = int(meta_length[0])
 
-        if file_size < min_size:
+        if file_size is not None and file_size < min_size:
             print ("Skipped : {0} Bytes: {1} < {2}".format(url, file_size, min_size))
             f.close()
-            rmfile(filename)
+            rmfile(temp)
             return    
 
         print("Downloading: {0} Bytes: {1}".format(url, file_size))        
@@ -78,4 +137,10 @@ def download_file(url, filename, min_size=0):
             status = "{0:16}".format(file_size_dl)
             if file_size:
                 status += "   [{0:6.2f}%]".format(file_size_dl * 100 / file_size)
-            status += chr(13)
\ No newline at end of file
+            status += chr(13)
+
+    if file_size is not None and file_size_dl != file_size:
+        rmfile(temp)
+        raise IOError("Truncated {0} : {1} of {2} bytes".format(url, file_size_dl, file_size))
+
+    os.rename(temp, filename)
@@ -0,0 +1,201 @@
+import sys
+import time
+import threading
+
+import cv2
+
+if sys.version_info >= (3,):
+    import queue
+else:
+    import Queue as queue
+
+
+def _put(q, item, drop=True, stop=None):
+    """
+        Put item to bounded queue. When drop is set and queue is full
+        the oldest item is removed (latest frame wins), otherwise waits until
+        there is free space or stop event is set
+        Returns:
+            dropped: int (number of removed items)
+    """
+    while not drop:
+        try:
+            q.put(item, timeout=0.1)
+            return 0
+        except queue.Full:
+            if stop is not None and stop.is_set():
+                return 0
+
+    dropped = 0
+    while True:
+        try:
+            q.put_nowait(item)
+            return dropped
+        except queue.Full:
+            try:
+                q.get_nowait()
+                dropped += 1
+            except queue.Empty:
+                pass
+
+
+class StageStats(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.count, self.total, self.dropped = 0, 0., 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+
+    def drop(self, count=1):
+        with self.lock:
+            self.dropped += count
+
+    def summary(self):
+        with self.lock:
+            latency = self.total / self.count * 1000. if self.count > 0 else 0.
+            return {'frames' : self.count, 'dropped' : self.dropped, 'latency_ms' : latency}
+
+
+class VideoDetector(object):
+    """
+        Detection on video stream with capture, inference and rendering in separate stages.
+        Stages are connected with bounded queues, stale frames are dropped instead of queued,
+        so display never waits for inference.
+        Rendering runs in the calling thread (cv2.imshow requires it on some platforms).
+    """
+
+    def __init__(self, net, source=0, queue_size=1, drop_frames=True, display=True, window='Frame', on_frame=None):
+        """
+            Args:
+                net: YoloNet (or any object with detect(image) and draw_detections(image, boxes))
+                source: camera id, video filename or stream url (anything cv2.VideoCapture accepts)
+                queue_size: int (capacity of queues between stages)
+                drop_frames: bool (latest frame wins; False - process every frame, e.g. for video files)
+                display: bool (show frames with cv2.imshow)
+                window: string (window name)
+                on_frame: callable(frame, boxes) called for each rendered frame (optional)
+        """
+        self.net = net
+        self.source = source
+        self.queue_size = queue_size
+        self.drop_frames = drop_frames
+        self.display = display
+        self.window = window
+        self.on_frame = on_frame
+
+        self.stats = dict((name, StageStats(name)) for name in ('capture', 'inference', 'render', 'end_to_end'))
+        self._stop = threading.Event()
+        self._elapsed = 0.
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self, max_frames=None):
+        """
+            Run pipeline until source ends, 'q' pressed, stop() called or max_frames rendered
+            Returns:
+                report: see report()
+        """
+        self._stop.clear()
+        frames  = queue.Queue(maxsize=self.queue_size)
+        results = queue.Queue(maxsize=self.queue_size)
+
+        camera = cv2.VideoCapture(self.source)
+        if not camera.isOpened():
+            print ("Can't open video source {0}".format(self.source))
+            return None
+
+        threads = [threading.Thread(target=self._capture, args=(camera, frames)),
+                   threading.Thread(target=self._inference, args=(frames, results))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        start = time.time()
+        try:
+            self._render(results, max_frames)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            for thread in threads:
+                thread.join()
+            camera.release()
+            if self.display:
+                cv2.destroyWindow(self.window)
+            self._elapsed = time.time() - start
+
+        return self.report()
+
+    def report(self):
+        """
+            Returns:
+                dict with per stage stats (frames, dropped, latency_ms) and end-to-end fps
+        """
+        report = dict((name, stats.summary()) for name, stats in self.stats.items())
+        rendered = report['render']['frames']
+        report['fps'] = rendered / self._elapsed if self._elapsed > 0 else 0.
+        return report
+
+    def _capture(self, camera, frames):
+        while not self._stop.is_set():
+            start = time.time()
+            ret, frame = camera.read()
+            if not ret:
+                break
+            self.stats['capture'].add(time.time() - start)
+            self.stats['capture'].drop(_put(frames, (frame, start), self.drop_frames, self._stop))
+        self._finish(frames)
+
+    def _inference(self, frames, results):
+        while not self._stop.is_set():
+            try:
+                item = frames.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            frame, captured = item
+
+            start = time.time()
+            boxes = self.net.detect(frame)
+            self.stats['inference'].add(time.time() - start)
+            self.stats['inference'].drop(_put(results, (frame, boxes, captured), self.drop_frames, self._stop))
+        self._finish(results)
+
+    def _finish(self, q):
+        # End of stream marker, never dropped by the next stage
+        _put(q, None, False, self._stop)
+
+    def _render(self, results, max_frames=None):
+        rendered = 0
+        while not self._stop.is_set():
+            try:
+                item = results.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            frame, boxes, captured = item
+
+            start = time.time()
+            frame = self.net.draw_detections(frame, boxes)
+            if self.on_frame is not None:
+                self.on_frame(frame, boxes)
+            if self.display:
+                cv2.imshow(self.window, frame)
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+
+            end = time.time()
+            self.stats['render'].add(end - start)
+            self.stats['end_to_end'].add(end - captured)
+
+            rendered += 1
+            if max_frames is not None and rendered >= max_frames:
+                break
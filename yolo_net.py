@@ -1,50 +1,164 @@
-from darkflow.net.build import TFNet
-import cv2
 import os
+import time
+import threading
+import json
 
-import common
 import numpy as np
 
-import json
+import backends
+
+# Heavy stacks (cv2, darkflow, tensorflow, ...) are imported on first use, see backends
+
 
 
 class YoloNet(object):
     
-    def __init__(self, options):
-        self.tfnet = TFNet(options)
-        with open(options['metaLoad'], 'r') as fp:
-            meta = json.load(fp)
-            self.labels    = meta['labels']        
+    def __init__(self, options, tfnet=None):
+        """
+            Args:
+                options: dict (darkflow options, backend - see backends.create, threshold - confidence
+                         threshold (non positive - thresh of meta, as in darkflow), nms_threshold,
+                         nms_class_agnostic, letterbox)
+                tfnet: already built darkflow TFNet (optional)
+        """
+        self.backend = backends.create(options, tfnet)
+        self.tfnet   = getattr(self.backend, 'tfnet', None)
+
+        meta = self.backend.meta
+        self.meta      = meta
+        self.labels    = meta['labels']        
+        self.threshold = options.get('threshold', 0)
+        if self.threshold is None or self.threshold <= 0:
             self.threshold = meta['thresh']
-            self.colors    = meta['colors']
+        self.colors    = meta['colors']
+
+        # Non-maximum suppression: IoU threshold (None - disabled) and per-class or class-agnostic mode
+        self.nms_threshold      = options.get('nms_threshold', 0.4)
+        self.nms_class_agnostic = options.get('nms_class_agnostic', False)
+
+        # Keep aspect ratio of input: image is resized to fit net input and padded with gray
+        self.letterbox = options.get('letterbox', False)
+
+        # Reusable preprocessing buffers (detect is not reentrant, use one YoloNet per thread)
+        h, w, c = self.meta['inp_size']
+        self._input    = np.empty((1, h, w, c), dtype=np.float32)
+        self._image    = self._input[0]
+        self._resized  = None
+        self._geometry = None
+
+        self.timings = {'startup_s' : None, 'first_inference_ms' : None}
     
         
+    def warmup(self, runs=1, batch_size=None):
+        """
+            Run dummy inference, so graph initialization and memory allocation are done
+            before the first real frame
+            Args:
+                runs: int (number of dummy inferences, the first one is the slowest)
+                batch_size: int (also warm up detect_batch with this batch size, optional)
+            Returns:
+                list of latencies (ms)
+        """
+        h, w, c = self.meta['inp_size']
+        image = np.zeros((h, w, c), dtype=np.uint8)
+        latencies = []
+        for _ in range(runs):
+            start = time.time()
+            self.detect(image)
+            latencies.append((time.time() - start) * 1000.)
+        if batch_size:
+            list(self.detect_batch([image] * batch_size, batch_size))
+
+        if self.timings['first_inference_ms'] is None:
+            self.timings['first_inference_ms'] = latencies[0]
+        print ("Warm up : first inference {0:.1f} ms, last {1:.1f} ms".format(latencies[0], latencies[-1]))
+        return latencies
+
     def detect(self, image):
-        input_image = self._resize_input(image)
-        this_inp = np.expand_dims(input_image, 0)
-        feed_dict = {self.tfnet.inp : this_inp}
+        self._resize_input(image, self._image)
+        res = self.backend.forward(self._input)[0]
+        return self._decode(res, image.shape[:2])
+
+    def detect_batch(self, images, batch_size=8):
+        """
+            Detect objects on many images, running one session call per batch
+            Args:
+                images: iterable (list or generator) of BGR images, sizes may differ
+                batch_size: int (number of images per session call)
 
-        res = self.tfnet.sess.run(self.tfnet.out, feed_dict)[0]
-        boxes = self.tfnet.framework.findboxes(res)
+            Yields:
+                boxes: detections for each image in the same order and format as detect
+        """
+        h, w, c = self.meta['inp_size']
+        batch = np.empty((batch_size, h, w, c), dtype=np.float32)
+        shapes = []
+        for image in images:
+            self._resize_input(image, batch[len(shapes)])
+            shapes.append(image.shape[:2])
+            if len(shapes) == batch_size:
+                for boxes in self._run_batch(batch, shapes):
+                    yield boxes
+                shapes = []
+
+        if len(shapes) > 0:
+            for boxes in self._run_batch(batch[:len(shapes)], shapes):
+                yield boxes
+
+    def _run_batch(self, batch, shapes):
+        out = self.backend.forward(batch)
+        return [self._decode(res, shape) for res, shape in zip(out, shapes)]
+
+    def _decode(self, res, shape):
+        xywh, probs = self._raw_boxes(res)
+        if self.letterbox:
+            xywh = self._undo_letterbox(xywh, shape)
         
-        h, w = image.shape[:2]
+        h, w = shape
+        class_ids = np.argmax(probs, axis=1)
+        confidences = probs[np.arange(len(class_ids)), class_ids]
+
+        keep = confidences > self.threshold
+        xywh, class_ids, confidences = xywh[keep], class_ids[keep], confidences[keep]
+
+        x, y, bw, bh = xywh[:, 0], xywh[:, 1], xywh[:, 2] / 2., xywh[:, 3] / 2.
+        left  = np.maximum(((x - bw) * w).astype(np.int64), 0)
+        right = np.minimum(((x + bw) * w).astype(np.int64), w - 1)
+        top   = np.maximum(((y - bh) * h).astype(np.int64), 0)
+        bot   = np.minimum(((y + bh) * h).astype(np.int64), h - 1)
+
+        if self.nms_threshold is not None:
+            indices = non_max_suppression(np.stack([left, top, right, bot], axis=1), confidences, 
+                                          None if self.nms_class_agnostic else class_ids, self.nms_threshold)
+        else:
+            indices = np.argsort(-confidences, kind='stable')
+
         clean_boxes = []
-        bx = []
-        for box in boxes:
-            tmpBox = self._process_box(box, h, w, self.threshold)
-            if tmpBox is None:
-                continue
-            left, right, top, bot, class_name, class_indx, confidence = tmpBox
-           
-            clean_boxes.append([[class_indx, class_name, confidence], [left, right, top, bot]])
-            
-        #clean_boxes = non_intersect_boxes(clean_boxes)
+        for i in indices:
+            class_indx = int(class_ids[i])
+            clean_boxes.append([[class_indx, '{}'.format(self.labels[class_indx]), float(confidences[i])], 
+                                [int(left[i]), int(right[i]), int(top[i]), int(bot[i])]])
         return clean_boxes    
+
+    def _raw_boxes(self, res):
+        """
+            Raw predictions of net as arrays
+            Returns:
+                xywh: (N x 4) box centers and sizes relative to image size
+                probs: (N x C) class probabilities
+        """
+        if self.meta.get('type') == '[region]':
+            return decode_region(res, self.meta)
+
+        boxes = self.backend.findboxes(res)
+        xywh = np.array([[b.x, b.y, b.w, b.h] for b in boxes], dtype=np.float64).reshape(-1, 4)
+        probs = np.array([b.probs for b in boxes], dtype=np.float64).reshape(-1, len(self.labels))
+        return xywh, probs
     
             
     def draw_detections(self, image, boxes):
         if (len(boxes)) <= 0:
             return image
+        import cv2
         h, w = image.shape[:2]
     
         thick = int((h + w) // 300)
@@ -58,31 +172,175 @@ class YoloNet(object):
         return image
            
         
-    def _resize_input(self, im):
-        h, w, c = self.tfnet.meta['inp_size']
-        imsz = cv2.resize(im, (w, h))
-        imsz = imsz / 255.
-        imsz = imsz[:,:,::-1]
-        return imsz
-
-    def _process_box(self, b, h, w, threshold):
-        max_indx = np.argmax(b.probs)
-        max_prob = b.probs[max_indx]
-        label = self.labels[max_indx]
-        if max_prob > threshold:
-            left  = int ((b.x - b.w/2.) * w)
-            right = int ((b.x + b.w/2.) * w)
-            top   = int ((b.y - b.h/2.) * h)
-            bot   = int ((b.y + b.h/2.) * h)
-            if left  < 0    :  left = 0
-            if right > w - 1: right = w - 1
-            if top   < 0    :   top = 0
-            if bot   > h - 1:   bot = h - 1
-            class_name = '{}'.format(label)
-            return (left, right, top, bot, class_name, max_indx, max_prob)
-        return None
-
-def create_net(model_name, folder, options):
-    options['pbLoad']   = os.path.join(os.path.abspath(folder), model_name + ".pb")
-    options['metaLoad'] = os.path.join(os.path.abspath(folder), model_name + ".meta")
-    return YoloNet(options)
+    def _letterbox_geometry(self, shape):
+        """
+            Placement of image inside net input
+            Returns:
+                (top, left, height, width) of resized image
+        """
+        h, w = self.meta['inp_size'][:2]
+        if not self.letterbox:
+            return 0, 0, h, w
+        scale = min(float(w) / shape[1], float(h) / shape[0])
+        nw, nh = max(int(round(shape[1] * scale)), 1), max(int(round(shape[0] * scale)), 1)
+        return (h - nh) // 2, (w - nw) // 2, nh, nw
+
+    def _undo_letterbox(self, xywh, shape):
+        """
+            Box centers and sizes relative to net input -> relative to original image
+        """
+        h, w = self.meta['inp_size'][:2]
+        top, left, nh, nw = self._letterbox_geometry(shape)
+        xywh = xywh.copy()
+        xywh[:, 0] = (xywh[:, 0] * w - left) / nw
+        xywh[:, 1] = (xywh[:, 1] * h - top) / nh
+        xywh[:, 2] *= float(w) / nw
+        xywh[:, 3] *= float(h) / nh
+        return xywh
+
+    def _resize_input(self, im, out=None):
+        """
+            Resize BGR image to net input, convert to RGB and scale to [0, 1]
+            into float32 buffer (no per frame allocations when image size doesn't change)
+            Args:
+                im: BGR uint8 image
+                out: float32 array (h x w x c) of net input size (None - internal buffer)
+            Returns:
+                out
+        """
+        import cv2
+        if out is None:
+            out = self._image
+        top, left, nh, nw = geometry = self._letterbox_geometry(im.shape)
+
+        if self._resized is None or self._resized.shape[1:] != (nh, nw) + im.shape[2:]:
+            self._resized = np.empty((2, nh, nw) + im.shape[2:], dtype=np.uint8)
+        resized, rgb = self._resized
+        cv2.resize(im, (nw, nh), dst=resized)
+        cv2.cvtColor(resized, cv2.COLOR_BGR2RGB, dst=rgb)
+
+        if self.letterbox and (nh, nw) != out.shape[:2] and (self._geometry != geometry or out is not self._image):
+            # Padding is the same for all frames of the same size, fill it only when geometry changes
+            out.fill(.5)
+            if out is self._image:
+                self._geometry = geometry
+
+        # float32 division gives the same values as previous float64 one, written straight into net input
+        np.divide(rgb, np.float32(255.), out=out[top:top + nh, left:left + nw])
+        return out
+
+def _sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+def decode_region(net_out, meta):
+    """
+        Decode YOLO v2 region layer output (same math as darkflow yolov2 findboxes, without NMS)
+        Args:
+            net_out: array (H x W x num * (5 + classes)) - raw output of net for single image
+            meta: dict with keys num (anchors count), classes, anchors (list of 2 * num floats)
+
+        Returns:
+            xywh: (N x 4) box centers and sizes relative to image size, N = H * W * num
+            probs: (N x classes) class probabilities multiplied by box confidence
+    """
+    H, W = net_out.shape[:2]
+    B, C = meta['num'], meta['classes']
+    anchors = np.reshape(meta['anchors'], (B, 2))
+
+    out = np.reshape(net_out, (H, W, B, 5 + C)).astype(np.float64)
+    cols = np.arange(W).reshape(1, W, 1)
+    rows = np.arange(H).reshape(H, 1, 1)
+
+    x = (cols + _sigmoid(out[..., 0])) / W
+    y = (rows + _sigmoid(out[..., 1])) / H
+    w = np.exp(out[..., 2]) * anchors[:, 0] / W
+    h = np.exp(out[..., 3]) * anchors[:, 1] / H
+    confidence = _sigmoid(out[..., 4])
+
+    classes = out[..., 5:]
+    classes = np.exp(classes - np.max(classes, axis=-1, keepdims=True))
+    probs = classes / np.sum(classes, axis=-1, keepdims=True) * confidence[..., np.newaxis]
+
+    xywh = np.stack([x, y, w, h], axis=-1).reshape(-1, 4)
+    return xywh, probs.reshape(-1, C)
+
+def non_max_suppression(boxes, scores, class_ids=None, iou_threshold=0.4):
+    """
+        Greedy non-maximum suppression
+        Args:
+            boxes: array (N x 4) of corners left, top, right, bottom
+            scores: array (N) of confidences
+            class_ids: array (N) of classes - suppress only boxes of the same class,
+                       None - class-agnostic (suppress any overlapping boxes)
+            iou_threshold: float (boxes with IoU above it are suppressed by the more confident one)
+
+        Returns:
+            indices of kept boxes sorted by score (descending)
+    """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    if boxes.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    if class_ids is not None:
+        # Shift boxes of each class to separate region, so boxes of different classes never overlap
+        offset = np.asarray(class_ids, dtype=np.float64) * (np.max(boxes) + 1)
+        boxes = boxes + offset[:, np.newaxis]
+
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+
+    order = np.argsort(-np.asarray(scores), kind='stable')
+    keep = []
+    while order.size > 0:
+        i, rest = order[0], order[1:]
+        keep.append(i)
+
+        iw = np.maximum(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0)
+        ih = np.maximum(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0)
+        intersection = iw * ih
+        union = areas[i] + areas[rest] - intersection
+        iou = np.where(union > 0, intersection / np.maximum(union, 1e-12), 0.)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+# Process-wide registry of loaded nets: (folder, model_name, options) -> YoloNet
+_nets = {}
+_nets_lock = threading.Lock()
+
+def create_net(model_name, folder, options, reuse=True, warmup=False):
+    """
+        Load net from <folder>/<model_name>.pb and .meta
+        Args:
+            options: dict (see YoloNet)
+            reuse: bool (return already loaded net for the same model and options, the net is shared,
+                   so use one net per thread or reuse=False)
+            warmup: bool (run dummy inference after load, see YoloNet.warmup)
+        Returns:
+            YoloNet
+    """
+    folder = os.path.abspath(folder)
+    key = (folder, model_name, json.dumps(options, sort_keys=True, default=str))
+    with _nets_lock:
+        if reuse and key in _nets:
+            return _nets[key]
+
+        start = time.time()
+        options = dict(options)
+        options['pbLoad']   = os.path.join(folder, model_name + ".pb")
+        options['metaLoad'] = os.path.join(folder, model_name + ".meta")
+        net = YoloNet(options)
+        net.timings['startup_s'] = time.time() - start
+        print ("Loaded {0} in {1:.2f} s".format(model_name, net.timings['startup_s']))
+
+        if warmup:
+            net.warmup()
+        if reuse:
+            _nets[key] = net
+    return net
+
+def clear_nets():
+    """
+        Forget loaded nets (they are freed when not used anymore)
+    """
+    with _nets_lock:
+        _nets.clear()